@@ -1,9 +1,15 @@
-from typing import Dict, Any, List, Optional, Union, Tuple
+import asyncio
+import socket
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Union, Tuple
+import bencodepy
 import requests
 from tqdm import tqdm
 from uuid import uuid4
+from urllib.parse import urlparse
 from peer_config import *
 from peer_download import *
+from peer_udp import udp_announce
 
 # seeding fomat
         # {
@@ -18,6 +24,10 @@ from peer_download import *
         # }
 
 class Peer:
+    # Cache phản hồi GET /torrents theo tham số truy vấn: {(search, limit, cursor): (etag, torrents, next_cursor)},
+    # chỉ giữ CATALOG_CACHE_SIZE trang dùng gần nhất
+    _catalog_cache: "OrderedDict[Tuple, Tuple[str, Dict, Optional[str]]]" = OrderedDict()
+
     def __init__(self, peer_port : int = None):
         self.port = peer_port or 6881
         self.ip = get_local_ip()
@@ -30,6 +40,10 @@ class Peer:
         """
         self.seeding_torrents = {}
         self.leeching_torrents = {}
+        # "min interval" tracker trả về cho từng torrent: {info_hash: giây}
+        self.min_announce_intervals: Dict[bytes, int] = {}
+        # Node của tracker cluster phục vụ từng torrent (học từ redirect): {info_hash: URL}
+        self.tracker_routes: Dict[bytes, str] = {}
         self.peer_id = os.urandom(50)
         # logger.info(f"Peer initialized with ID: {self.peer_id.hex()}, listening on {self.ip}:{self.port}")
 
@@ -43,9 +57,45 @@ class Peer:
         if torrent.announce and torrent.announce not in urls:
             urls.insert(0, torrent.announce)  # Ưu tiên announce chính
         # Lọc bỏ các URL không hợp lệ hoặc trùng lặp (ví dụ None)
-        return [url for url in urls if isinstance(url, str) and url.startswith(('http://', 'https://'))]
+        return [url for url in urls if isinstance(url, str) and url.startswith(('http://', 'https://', 'udp://'))]
+
+    @staticmethod
+    def _http_tracker_url(tracker_url: str) -> str:
+        """
+        UDP tracker (BEP 15) chạy cùng host:port với HTTP tracker, nên các API chỉ có
+        trên HTTP (upload .torrent, danh mục torrent) dùng cùng địa chỉ với scheme http.
+        """
+        url = urlparse(tracker_url)
+        if url.scheme == "udp":
+            return f"http://{url.netloc}"
+        return tracker_url
 
-    def _send_request_to_tracker(self, torrent_filepath: str, event: str = None) -> requests.Response:
+    @staticmethod
+    def _decode_announce_reply(content: bytes) -> Dict[str, Any]:
+        """
+        Giải mã phản hồi announce dạng compact (BEP 23, BEP 7 cho IPv6) của tracker.
+        Returns: {"interval": <giây>, "min_interval": <giây hoặc None>, "peers": [{"ip": ip, "port": port}, ...]}
+        """
+        data = bencodepy.decode(content)
+        if b"failure reason" in data:
+            raise RuntimeError(f"Tracker failure: {data[b'failure reason'].decode('utf-8', 'replace')}")
+        peer_list = []
+        for key, family, ip_length in ((b"peers", socket.AF_INET, 4), (b"peers6", socket.AF_INET6, 16)):
+            raw = data.get(key, b"")
+            step = ip_length + 2
+            for offset in range(0, len(raw) - step + 1, step):
+                peer_list.append({
+                    "ip": socket.inet_ntop(family, raw[offset:offset + ip_length]),
+                    "port": int.from_bytes(raw[offset + ip_length:offset + step], "big")
+                })
+        return {"interval": data.get(b"interval"), "min_interval": data.get(b"min interval"), "peers": peer_list}
+
+    def _send_request_to_tracker(self, torrent_filepath: str, event: str = None,
+                                 left: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Announce torrent tới tracker.
+        left: số byte còn thiếu (0 với seeder); None để tracker giữ nguyên trạng thái hiện tại của peer.
+        """
         torrent = TorrentFile(torrent_filepath)
         tracker_url = torrent.get_tracker_url(torrent_filepath=torrent_filepath)
         logger.info(f"At _send_request_to_tracker, Tracker URL is: {tracker_url}")
@@ -53,26 +103,81 @@ class Peer:
             "info_hash": torrent.info_hash.hex(),
             "peer_id": self.peer_id,
             "port": self.port,
-            "ip": self.ip
+            "ip": self.ip,
+            "compact": 1
         }
 
         if event:
             dict["event"] = event
+        if left is not None:
+            dict["left"] = left
         try:
-            response = requests.get(tracker_url + "/announce", params=dict, timeout=20)
+            if tracker_url.startswith("udp://"):
+                return udp_announce(tracker_url, torrent.info_hash, self.peer_id, self.port,
+                                    ip=self.ip, event=event, left=left or 0)
+            route_url = self.tracker_routes.get(torrent.info_hash, tracker_url)
+            try:
+                response = requests.get(route_url + "/announce", params=dict, timeout=20)
+            except requests.exceptions.RequestException:
+                # Node đã học có thể đã down: lần sau hỏi lại tracker gốc để được chuyển tới node khác
+                self.tracker_routes.pop(torrent.info_hash, None)
+                raise
             response.raise_for_status()  # Raise error if status is not 200
-            return response
+            if response.history:
+                # Tracker cluster chuyển announce tới node phục vụ info_hash: các lần sau gửi thẳng tới node đó
+                self.tracker_routes[torrent.info_hash] = response.url.split("/announce", 1)[0]
+            reply = self._decode_announce_reply(response.content)
+            if reply["min_interval"]:
+                self.min_announce_intervals[torrent.info_hash] = reply["min_interval"]
+            return reply
         except requests.exceptions.Timeout:
                 logger.warning(f"Timeout connecting to tracker: {tracker_url}")
         except requests.exceptions.RequestException as e:
                 logger.warning(f"Error connecting to tracker.\nError: {str(e)}")
+        except (OSError, RuntimeError) as e:
+                logger.warning(f"Error connecting to UDP tracker {tracker_url}: {str(e)}")
         except Exception as e:
             logger.error(f"Error occurs in _send_request_to_tracker: {str(e)}")
             raise
 
+    def _send_batch_to_tracker(self, torrent_filepaths: List[str], event: str = None):
+        """
+        Announce nhiều torrent đang seed (left = 0) bằng POST /announce/batch, gom theo tracker
+        và chia thành lô ANNOUNCE_BATCH_SIZE torrent. Tracker cũ chưa có API batch (404)
+        được announce lần lượt từng torrent như trước.
+        """
+        batches: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        for torrent_filepath in torrent_filepaths:
+            try:
+                torrent = TorrentFile(torrent_filepath)
+                tracker_url = self._http_tracker_url(torrent.get_tracker_url(torrent_filepath=torrent_filepath))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skip announcing '{torrent_filepath}': {str(e)}")
+                continue
+            item = {"info_hash": torrent.info_hash.hex(), "event": event, "left": 0}
+            batches.setdefault(tracker_url, []).append((torrent_filepath, item))
+
+        for tracker_url, entries in batches.items():
+            for start in range(0, len(entries), ANNOUNCE_BATCH_SIZE):
+                chunk = entries[start:start + ANNOUNCE_BATCH_SIZE]
+                try:
+                    response = requests.post(tracker_url + "/announce/batch",
+                                             json={"port": self.port, "ip": self.ip,
+                                                   "announces": [item for _, item in chunk]},
+                                             timeout=20)
+                    if response.status_code == 404:
+                        logger.info(f"Tracker {tracker_url} has no batch announce, announcing one by one")
+                        for torrent_filepath, _ in chunk:
+                            self._send_request_to_tracker(torrent_filepath, event=event, left=0)
+                        continue
+                    response.raise_for_status()
+                    logger.info(f"Announced {len(chunk)} torrents (event={event}) to {tracker_url}")
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f"Error sending batch announce to {tracker_url}.\nError: {str(e)}")
+
     def _upload_torrent_to_tracker(self, name : str, description: str, torrent_filepath: str) -> Optional[requests.Response]:
         torrent = TorrentFile(torrent_filepath)
-        tracker_url = torrent.get_tracker_url(torrent_filepath)
+        tracker_url = self._http_tracker_url(torrent.get_tracker_url(torrent_filepath))
         logger.info(f"At _upload_torrent_to_tracker, Tracker URL is: {tracker_url}")
         with open(torrent_filepath, "rb") as f:
             files = {"file": f}
@@ -153,7 +258,6 @@ class Peer:
             raise
 
     def _seed_after_downloading(self, input_path: str, input_torrent_filepath: str):
-        self._send_request_to_tracker(input_torrent_filepath, event="started")
         try:
             if not os.path.exists(input_path):
                 raise FileNotFoundError(f"'{input_path}' does not exists.")
@@ -172,7 +276,7 @@ class Peer:
                 "torrent_filepath": torrent.filepath,
                 "filepath": input_path
             }
-            self._send_request_to_tracker(input_torrent_filepath, event="started")
+            self._send_request_to_tracker(input_torrent_filepath, event="completed", left=0)
             logger.info(f"Added completed torrent '{torrent.filename}' (Hash: {torrent.info_hash}) to seeding list.")
         except FileNotFoundError as e:
             logger.error(f"File not found during seed_after_downloading: {str(e)}")
@@ -184,14 +288,16 @@ class Peer:
                                     torrent: TorrentFile,
                                     torrent_info: Dict,
                                     index: int,
-                                    length: int): # -> Optional[bytes]:
+                                    length: int,
+                                    begin: int = 0): # -> Optional[bytes]:
         """
-        Lấy dữ liệu block(piece) (index, length) từ file/folder đang seed.
+        Lấy dữ liệu block (index, begin, length) từ file/folder đang seed.
         Args:
             torrent: torrent file đang seed
             torrent_info: Dict chứa thông tin torrent đang seed từ self.seeding_torrents.
             index: Chỉ số piece.
             length: Độ dài block cần đọc (bytes).
+            begin: Vị trí bắt đầu của block trong piece.
         Returns:
             Dữ liệu block (bytes) hoặc None nếu có lỗi.
         """
@@ -202,14 +308,14 @@ class Peer:
             if not torrent.is_multifile: #Trường hợp Single File
                 async with aiofiles.open(data_path, "rb") as f:
                     # await f.seek(index * piece_length)
-                    await f.seek(index * piece_length)
+                    await f.seek(index * piece_length + begin)
                     block_data = await f.read(length)
                     # Debug: Lưu dữ liệu piece gửi đi
                     # with open(f"piece_{index}_sent.bin", "wb") as f:
                     #     f.write(block_data)
             else: #Trường hợp Multi-file
                 block_data = b""
-                offset = index * piece_length
+                offset = index * piece_length + begin
                 read_len = length
                 for path, file_size in torrent.files:
                     if offset < file_size:
@@ -233,6 +339,39 @@ class Peer:
             return None
 
 
+    @staticmethod
+    async def _receive_requests(messages: MessageReader, writer: asyncio.StreamWriter,
+                                request_queue: asyncio.Queue, cancelled: Set[Tuple[int, int, int]], addr):
+        """
+        Đọc message từ leecher: Request vào request_queue, Cancel vào cancelled, Interested được trả lời
+        bằng Unchoke (seeder không choke ai). Đặt None vào hàng đợi khi kết nối kết thúc.
+        """
+        try:
+            while True:
+                # Chờ message tiếp theo với timeout
+                message = await asyncio.wait_for(messages.read(), timeout=KEEPALIVE_TIMEOUT)
+                if isinstance(message, Cancel):
+                    cancelled.add((message.index, message.begin, message.length))
+                elif isinstance(message, Request):
+                    cancelled.discard((message.index, message.begin, message.length))
+                    await request_queue.put(message)
+                elif isinstance(message, Interested):
+                    writer.write(Unchoke().encode())
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionResetError, ValueError) as e:
+            logger.info(f"Seeder: Stopped reading requests from {addr}. Reason: {type(e).__name__}")
+        finally:
+            if request_queue.full():
+                request_queue.get_nowait()
+            request_queue.put_nowait(None)
+
+    @staticmethod
+    def _is_valid_request(torrent: TorrentFile, request: Request) -> bool:
+        """Request phải nằm trong một piece có thật và dài không quá BLOCK_SIZE."""
+        if request.index >= torrent.number_of_pieces or not 0 < request.length <= BLOCK_SIZE:
+            return False
+        piece_size = min(torrent.piece_length, torrent.total_size - request.index * torrent.piece_length)
+        return request.begin + request.length <= piece_size
+
     async def _handle_uploader(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """
                 Xử lý kết nối từ một leecher (client yêu cầu dữ liệu) để seed file.
@@ -241,62 +380,82 @@ class Peer:
         addr = writer.get_extra_info("peername")
         try:
             #xac thuc handshake
-            request = await asyncio.wait_for(reader.read(68), timeout=10) #read 68 byte handshake
-            if not request:
-                raise Exception(f"Connection to client {addr} closed")
+            request = await asyncio.wait_for(reader.readexactly(Handshake.length), timeout=10) #read 68 byte handshake
             if not Handshake.is_valid(request):
                 raise Exception("Seeder: Handshake response is not valid")
 
             #decode handshake nhan duoc de lay info hash
             handshake_request = Handshake.decode(request)
             info_hash = handshake_request.info_hash
-            #xac dinh torrent can seed
-            if info_hash not in self.seeding_torrents:
+            #xac dinh torrent can seed: torrent đang seed, hoặc đang tải (chỉ gửi các piece đã tải xong)
+            piece_manager: Optional[PieceManage] = None
+            if info_hash in self.seeding_torrents:
+                torrent_info = self.seeding_torrents[info_hash]
+                torrent = TorrentFile(torrent_info["torrent_filepath"])
+                bitfield = pack_bitfield(b"\x01" * torrent.number_of_pieces)
+            elif info_hash in self.leeching_torrents:
+                piece_manager = self.leeching_torrents[info_hash]
+                torrent = piece_manager.torrent
+                torrent_info = {"torrent_filepath": torrent.filepath, "filepath": piece_manager.output_name}
+                bitfield = piece_manager.bitfield()
+            else:
                 raise Exception(f"Seeder: No seed torrent with info_hash {info_hash} in this peer. Connection closed.")
 
-            torrent_info = self.seeding_torrents[info_hash]
-            torrent = TorrentFile(torrent_info["torrent_filepath"])
-
             #gui handshake phan hoi #gui ack
             response_handshake = Handshake(info_hash).encode() #gui lai in4 hash nhan dc
 
             writer.write(response_handshake)
+            writer.writelines(BitField(bitfield).encode_parts())
+            if piece_manager:
+                # Các piece tải xong sau BitField được báo bằng Have
+                piece_manager.peer_writers.add(writer)
             await writer.drain()
             # logger.info(f"peer::_handle_uploader::Seeder: reply handshake has been sent.")
 
             #Lang nghe va xu ly yeu cau
-            max_attempts = 300
-            total_hash = len(self.seeding_torrents)
-            attempts = 0
-            while attempts < max_attempts:
-                # Đọc độ dài message (4 bytes) với timeout
-                message = await asyncio.wait_for(reader.read(4), timeout=12)
-                if not message:
-                    break
-                #message = 13 or -1 if Done
-                # PeerMessage.Request, 1b
-                # self.index,   4b
-                # self.begin,   4b
-                # self.length   4b
-                message_length = struct.unpack('>I', message)[0] #13
-                if message_length == -1:
-                    break
-                message = await asyncio.wait_for(reader.read(message_length), timeout=12)
-                (id, index, begin, length) = struct.unpack('>bIII', message)
-                piece = await self._get_piece_for_seeding(torrent, torrent_info, index, length)
-                piece_message = Piece(index, begin, piece).encode()
-                writer.write(piece_message)
-                await writer.drain()
-                tqdm.write(f"Sent PIECE with index {index} to peer {addr}")
-                attempts += 1
+            # Task đọc nhận request liên tục vào hàng đợi trong khi vòng dưới đọc đĩa và gửi block,
+            # nên leecher có thể gửi nhiều request cùng lúc (pipelining)
+            request_queue: asyncio.Queue = asyncio.Queue(MAX_QUEUED_REQUESTS)
+            cancelled: Set[Tuple[int, int, int]] = set()
+            receiver = asyncio.create_task(
+                self._receive_requests(MessageReader(reader), writer, request_queue, cancelled, addr))
+            try:
+                while True:
+                    request = await request_queue.get()
+                    if request is None:
+                        break
+                    if not self._is_valid_request(torrent, request):
+                        logger.warning(f"Seeder: Invalid request (index {request.index}, begin {request.begin}, "
+                                       f"length {request.length}) from {addr}. Closing connection.")
+                        break
+                    if piece_manager and piece_manager.pieces_status[request.index] != PieceStatus.COMPLETED:
+                        continue
+                    if cancelled:
+                        request_key = (request.index, request.begin, request.length)
+                        if request_key in cancelled:
+                            cancelled.discard(request_key)
+                            continue
+                    piece = await self._get_piece_for_seeding(torrent, torrent_info, request.index,
+                                                              request.length, request.begin)
+                    if piece is None:
+                        break
+                    # Header và block được gửi riêng, block không bị chép vào message mới
+                    writer.writelines(Piece(request.index, request.begin, piece).encode_parts())
+                    # drain chỉ chờ khi buffer gửi vượt ngưỡng, không chờ leecher nhận từng block
+                    await writer.drain()
+                    logger.debug(f"Sent block {request.begin} of piece {request.index} to peer {addr}")
+            finally:
+                receiver.cancel()
+                if piece_manager:
+                    piece_manager.peer_writers.discard(writer)
             writer.close()
             await writer.wait_closed()
         except asyncio.CancelledError:
             logger.info(f"Seeder: Peer had closed connection (IncompleteReadError).")
             raise
         except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+            # Leecher đóng kết nối khi đã đủ piece, có thể còn request trùng chưa được trả lời
             logger.info(f"Seeder: Connection closed by peer during operation. Reason: {type(e).__name__}")
-            raise
         except Exception as e:
             logger.error(f"Seeder: Unexpected error handling connection: {e}", exc_info=True)
             raise
@@ -305,11 +464,10 @@ class Peer:
 
 
 
-    def _get_peers(self, torrent_filepath: str) -> Dict[str, Any]: #Dict[str, Any]:
+    def _get_peers(self, torrent_filepath: str, left: Optional[int] = None) -> List[Dict[str, Any]]:
         try:
-            response = self._send_request_to_tracker(torrent_filepath)
-            data = response.json()
-            peers = data.get("peers", {})
+            data = self._send_request_to_tracker(torrent_filepath, left=left)
+            peers = data.get("peers", []) if data else []
             if not peers:
                 logger.warning("Tracker returned no peers.")
             else:
@@ -317,19 +475,65 @@ class Peer:
             return peers
         except Exception as e:
             logger.error(f"Error getting peers from tracker: {e}")
-            return {}
+            return []
+
+    @staticmethod
+    def scrape(info_hashes: List[str], batch_size: int = 100) -> Dict[str, Dict[str, int]]:
+        """
+        Lấy số seeder/leecher/lượt tải xong của nhiều torrent từ /scrape của tracker.
+        Returns: {info_hash: {"complete": int, "incomplete": int, "downloaded": int}}
+        """
+        files = {}
+        try:
+            for start in range(0, len(info_hashes), batch_size):
+                response = requests.get(TRACKER_URL + "/scrape",
+                                        params={"info_hash": info_hashes[start:start + batch_size]},
+                                        timeout=20)
+                response.raise_for_status()
+                files.update(response.json().get("files", {}))
+            return files
+        except requests.HTTPError as e:
+            raise RuntimeError(f"HTTP error occurred: {e}") from e
+        except requests.RequestException as e:
+            raise RuntimeError(f"Request error occurred: {e}") from e
 
     @staticmethod
-    def get_torrents():
+    def get_torrents_page(search: str = None, limit: int = None, cursor: str = None) -> Tuple[Dict, Optional[str]]:
+        """
+        Lấy một trang danh mục torrent từ tracker.
+        Phản hồi được cache theo ETag: nếu danh mục không đổi tracker trả 304 và không gửi lại body.
+        Returns: (torrents, cursor của trang tiếp theo hoặc None)
+        """
+        params = {key: value for key, value in (("q", search), ("limit", limit), ("cursor", cursor)) if value}
+        cache_key = (search, limit, cursor)
+        cached = Peer._catalog_cache.get(cache_key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
         try:
-            response = requests.get(TRACKER_URL + "/torrents")
+            response = requests.get(TRACKER_URL + "/torrents", params=params, headers=headers, timeout=20)
+            if response.status_code == 304 and cached:
+                Peer._catalog_cache.move_to_end(cache_key)
+                return cached[1], cached[2]
             response.raise_for_status()  # Raises HTTPError for bad responses (4XX or 5XX)
             torrents = response.json()
-            return torrents
+            next_cursor = response.headers.get("X-Next-Cursor")
+            if response.headers.get("ETag"):
+                Peer._catalog_cache[cache_key] = (response.headers["ETag"], torrents, next_cursor)
+                Peer._catalog_cache.move_to_end(cache_key)
+                while len(Peer._catalog_cache) > CATALOG_CACHE_SIZE:
+                    Peer._catalog_cache.popitem(last=False)
+            return torrents, next_cursor
         except requests.HTTPError as e: # HTTP errors (404, 500, ...)
             raise RuntimeError(f"HTTP error occurred: {e}") from e
         except requests.RequestException as e: # Other requests issues
             raise RuntimeError(f"Request error occurred: {e}") from e
+
+    @staticmethod
+    def get_torrents(search: str = None):
+        try:
+            torrents, _ = Peer.get_torrents_page(search=search)
+            return torrents
+        except RuntimeError:
+            raise
         except Exception as e:
             raise Exception("Error occured during getting torrents from tracker") from e
 
@@ -372,6 +576,9 @@ class Peer:
         """
         peer_ip = peer.get("ip")
         peer_port = peer.get("port")
+        outstanding: Dict[Tuple[int, int], Request] = {}  # Request đã gửi nhưng chưa nhận được block: {(index, begin): Request}
+        # Các piece peer bên kia có, cập nhật theo BitField/Have; chỉ yêu cầu piece peer có
+        peer_pieces = PeerPieces(torrent.number_of_pieces)
         try:
             # logger.info(f"Connecting to peer {peer_ip}:{peer_port}...")
             reader, writer = await asyncio.wait_for(asyncio.open_connection(peer_ip, peer_port), timeout=12)
@@ -386,7 +593,7 @@ class Peer:
 
             # Nhận handshake response
             try:
-                response = await asyncio.wait_for(reader.read(Handshake.length), timeout=12)
+                response = await asyncio.wait_for(reader.readexactly(Handshake.length), timeout=12)
                 # Validate handshake
                 if not Handshake.is_valid(response):
                     logger.warning(f"Received invalid handshake from {peer_ip}:{peer_port}")
@@ -407,41 +614,42 @@ class Peer:
                 return
             logger.info(f"Handshake successful with {peer_ip}:{peer_port}")
 
-            peer_is_unchoke = True  # Giả định peer đc unchoke từ đầu
-            while peer_is_unchoke and not piece_manager.completed:
-                try:
-                    #gui yeu cau tai
-                    request = piece_manager.get_request_message()
-                    if not request:
-                        logger.info(f"Take all pieces to needed from {peer}.")
-                        break
-                    writer.write(request)
+            writer.write(Interested().encode())
+            # Giữ tới PIPELINE_DEPTH request đang chờ; task đọc nhận block và báo khi có chỗ trống
+            slot_free = asyncio.Event()
+            unchoked = asyncio.Event()
+            unchoked.set()  # Giả định peer đc unchoke từ đầu
+            receiver = asyncio.create_task(self._receive_blocks(MessageReader(reader), piece_manager, outstanding,
+                                                                slot_free, unchoked, peer_pieces, peer))
+            try:
+                while not piece_manager.completed:
+                    slot_free.clear()
+                    requests_parts = []
+                    while unchoked.is_set() and len(outstanding) < PIPELINE_DEPTH:
+                        request = piece_manager.get_request_message(skip=outstanding, peer=peer_pieces)
+                        if not request:
+                            break
+                        outstanding[(request.index, request.begin)] = request
+                        requests_parts.extend(request.encode_parts())
+                    writer.writelines(requests_parts)
                     await writer.drain()
-                    #nhan phan hoi
-                    length_prefix = await asyncio.wait_for(reader.readexactly(4), timeout=10 * 2)  # Chờ lâu hơn để bên kia ghi
-                    if not length_prefix:
-                        raise Exception(f"Connection to {peer} closed (NULL response after sending request).")
-                    message_length = struct.unpack('>I', length_prefix[:4])[0] # >= 9
-                    # logger.info(f"length_prefix = {length_prefix}. Received message_length = {message_length} bytes")
-
-                    # <length prefix> = 9
-                    # <message ID> = 1 byte(value = 7)
-                    # <index> = int = 4 byte
-                    # <begin> = int = 4 byte
-                    # <block> = data sent
-                    message_body = await asyncio.wait_for(reader.readexactly(message_length), timeout=24)
-                    # <message ID> <index> <begin> <block>
-                    # logger.info(f"Received message_body with length {len(message_body)} bytes")
-                    if not message_body:
-                        raise Exception(f"Connection to {peer} closed (response with NULL message body).")
-                    if len(message_body) != message_length:
-                        raise Exception(f"Incomplete message: expected {message_length}, got {len(message_body)}")
-                    index = await piece_manager.receive_piece(message_body)
-                    if index:
-                        logger.info(f"Received piece with index {index} from {peer}.")
-                except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError, asyncio.TimeoutError) as e:
-                    logger.error(f"Connection error or timeout while waiting for Unchoke from {peer_ip}:{peer_port}: {e}")
-                    raise
+                    # Chờ block về, Have/BitField mới, hoặc lần đánh thức định kỳ khi không còn gì để yêu cầu
+                    slot_waiter = asyncio.create_task(slot_free.wait())
+                    done, _ = await asyncio.wait((receiver, slot_waiter), timeout=KEEPALIVE_INTERVAL,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    slot_waiter.cancel()
+                    if not done:
+                        # Chưa có gì để yêu cầu (peer chưa có piece mới): báo cho seeder kết nối vẫn dùng
+                        writer.write(KeepAlive().encode())
+                    if receiver.done():
+                        receiver.result()  # Lỗi của task đọc (mất kết nối, timeout, piece sai hash)
+                        break
+            except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError, asyncio.TimeoutError) as e:
+                logger.error(f"Connection error or timeout while downloading from {peer_ip}:{peer_port}: {e}")
+                raise
+            finally:
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
             # writer.write(struct.pack('>I', -1)) #Thank you, we can close connection now
             # await writer.drain()
             writer.close()
@@ -449,10 +657,89 @@ class Peer:
         except Exception as e:
             logger.error(f"Peer::_download_from_peer()::An error occurred when downloading piece(s): {str(e)}", exc_info=True)
         finally:
+            for request in outstanding.values():
+                piece_manager.release_request(request)
+            piece_manager.peer_left(peer_pieces)
             if piece_manager and (peer in piece_manager.active_peers):
                 piece_manager.active_peers.remove(peer)
             logger.info(f"Disconnected from peer {peer_ip}:{peer_port}")
 
+    @staticmethod
+    async def _receive_blocks(messages: MessageReader,
+                              piece_manager: PieceManage,
+                              outstanding: Dict[Tuple[int, int], Request],
+                              slot_free: asyncio.Event,
+                              unchoked: asyncio.Event,
+                              peer_pieces: PeerPieces,
+                              peer: Dict):
+        """
+        Đọc liên tục message của một kết nối tải: giao block cho piece_manager và giải phóng chỗ
+        trong pipeline, theo dõi Choke/Unchoke và các piece peer có (BitField/Have).
+        """
+        while True:
+            try:
+                message = await asyncio.wait_for(messages.read(), timeout=10 * 2)
+            except asyncio.TimeoutError:
+                if outstanding:
+                    raise
+                # Không chờ block nào: peer chỉ chưa có piece mới, đánh thức vòng gửi để kiểm tra lại
+                slot_free.set()
+                continue
+            if isinstance(message, Piece):
+                index = await piece_manager.receive_piece(message)
+                # Chỉ giải phóng chỗ sau khi block đã được xử lý xong (piece đủ block thì đã ghi xuống đĩa)
+                outstanding.pop((message.index, message.begin), None)
+                if index is not None:
+                    logger.info(f"Received piece with index {index} from {peer}.")
+            elif isinstance(message, Choke):
+                # Peer bỏ mọi request đang chờ khi choke: trả các block đó cho kết nối khác
+                unchoked.clear()
+                for request in outstanding.values():
+                    piece_manager.release_request(request)
+                outstanding.clear()
+            elif isinstance(message, Unchoke):
+                unchoked.set()
+            elif isinstance(message, BitField):
+                piece_manager.peer_bitfield(peer_pieces, message.bitfield)
+            elif isinstance(message, Have):
+                piece_manager.peer_have(peer_pieces, message.index)
+            else:
+                continue
+            slot_free.set()
+
+    def _connect_to_peers(self, piece_manager: PieceManage, torrent: TorrentFile, peer_list: List[Dict[str, Any]]):
+        """Tạo task tải từ các peer chưa kết nối (bỏ qua chính peer này)."""
+        for p in peer_list:
+            if p not in piece_manager.active_peers and p != {"ip": self.ip, "port": self.port}:
+                asyncio.create_task(self._download_from_peer(piece_manager, torrent, p))
+
+    async def _watch_swarm(self, piece_manager: PieceManage, torrent: TorrentFile):
+        """
+        Theo dõi peer vào swarm qua GET /peers/subscribe của tracker (long-poll) và kết nối
+        ngay tới peer mới cho tới khi tải xong. Tracker không hỗ trợ (404) thì dừng, việc
+        tìm peer khi đó chỉ dựa vào announce định kỳ trong _download.
+        """
+        tracker_url = self._http_tracker_url(torrent.get_tracker_url(torrent_filepath=torrent.filepath))
+        params = {"info_hash": torrent.info_hash.hex(), "timeout": SUBSCRIBE_TIMEOUT}
+        while not piece_manager.completed:
+            try:
+                response = await asyncio.to_thread(requests.get, tracker_url + "/peers/subscribe",
+                                                   params=params, timeout=SUBSCRIBE_TIMEOUT + 10)
+                if response.status_code == 404:
+                    logger.info(f"Tracker {tracker_url} does not support peer subscriptions.")
+                    return
+                response.raise_for_status()
+                data = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning(f"Error subscribing to peers of {torrent.filename}: {str(e)}")
+                params.pop("cursor", None)
+                await asyncio.sleep(INTERVAL)
+                continue
+            params["cursor"] = data["cursor"]
+            if data["joined"]:
+                logger.info(f"{len(data['joined'])} peers joined the swarm of {torrent.filename}.")
+                self._connect_to_peers(piece_manager, torrent, data["joined"])
+
     async def _download(self, torrent_filepath: str, output_dir: str = None, pbar_position: int = 0):
         """ Quản lý quá trình download """
         output_dir = output_dir or DOWNLOAD_DIR
@@ -464,9 +751,13 @@ class Peer:
         torrent = TorrentFile(torrent_filepath)
         piece_manager = PieceManage(torrent=torrent, output_dir=output_dir)
         total_pieces = torrent.number_of_pieces
+        # Các piece đã tải xong được gửi cho peer khác ngay trong lúc tải (xem _handle_uploader)
+        self.leeching_torrents[torrent.info_hash] = piece_manager
 
         max_attempts = 3  # Số lần thử tối đa khi không có peers
         attempt = 0
+        watch_task = None
+        announced = False  # Đã gửi "started" cho tracker
         try:
             with tqdm(total=total_pieces,
                       desc=f"DL {os.path.basename(torrent.filename)}",
@@ -474,21 +765,28 @@ class Peer:
                       leave=True,
                       unit="piece") as pbar:
 
+                # Đăng ký với tracker như một leecher để scrape đếm được số peer đang tải
+                self._send_request_to_tracker(torrent_filepath, event="started", left=piece_manager.bytes_left)
+                announced = True
+                # Peer mới vào swarm được kết nối ngay qua long-poll, không phải chờ lần hỏi tracker tiếp theo
+                watch_task = asyncio.create_task(self._watch_swarm(piece_manager, torrent))
                 while not piece_manager.completed and attempt < max_attempts:
-                    peer_list = self._get_peers(torrent_filepath)
+                    peer_list = self._get_peers(torrent_filepath, left=piece_manager.bytes_left)
+                    # Không hỏi tracker dày hơn "min interval" của nó: announce sớm hơn chỉ nhận lại danh sách cũ
+                    poll_interval = max(INTERVAL, self.min_announce_intervals.get(torrent.info_hash, 0))
 
                     if not peer_list:
                         logger.warning("No peers available, retrying...")
                         attempt += 1
-                        await asyncio.sleep(INTERVAL)
-                        continue
-                    attempt = 0  # Reset số lần thử nếu có peers
-
-                    for p in peer_list:
-                        if p not in piece_manager.active_peers :
-                                asyncio.create_task(self._download_from_peer(piece_manager,torrent,p,pbar_position))
-                    await asyncio.sleep(INTERVAL) #can sleep moi lan kiem tra
-                if attempt >= max_attempts:
+                    else:
+                        attempt = 0  # Reset số lần thử nếu có peers
+                        self._connect_to_peers(piece_manager, torrent, peer_list)
+                    # Chờ tới lần hỏi tracker tiếp theo, hoặc dừng ngay khi tải xong
+                    try:
+                        await asyncio.wait_for(piece_manager.completed_event.wait(), poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                if not piece_manager.completed:
                     logger.error("Failed to download: No peers available after multiple attempts.")
                     return
             # --- Download Hoàn Thành ---
@@ -503,8 +801,25 @@ class Peer:
             logger.info(f"Now seeding: {piece_manager.output_name}")
         except Exception as e:
             logger.error(f"Unexpected error in download: {e}", exc_info=True)
+        finally:
+            if watch_task:
+                watch_task.cancel()
+            self.leeching_torrents.pop(torrent.info_hash, None)
+            if announced and not piece_manager.completed:
+                # Tải dừng giữa chừng (không có peer, lỗi, bị huỷ): tracker không được tiếp tục đếm leecher này
+                try:
+                    self._send_request_to_tracker(torrent_filepath, event="stopped", left=piece_manager.bytes_left)
+                except Exception as e:
+                    logger.warning(f"Could not send stopped for {torrent_filepath}: {e}")
 
 
+    async def _reannounce_periodically(self):
+        """Announce lại định kỳ mọi torrent đang seed để tracker không loại peer vì hết hạn."""
+        while True:
+            await asyncio.sleep(ANNOUNCE_INTERVAL)
+            torrent_filepaths = [stat["torrent_filepath"] for stat in list(self.seeding_torrents.values())]
+            await asyncio.to_thread(self._send_batch_to_tracker, torrent_filepaths)
+
     async def start_seeding(self):
         """
         Coroutine chính để khởi động server lắng nghe kết nối từ các peer khác.
@@ -520,8 +835,16 @@ class Peer:
             # logger.info(f"Peer start listening connection on {addr[0]}:{addr[1]}")
             # print(f"Peer start listening connection on {addr[0]}:{addr[1]}")
 
-            async with server:
-                await server.serve_forever()
+            # Announce lại mọi torrent đã có trong danh sách seed trước khi server chạy
+            torrent_filepaths = [stat["torrent_filepath"] for stat in list(self.seeding_torrents.values())]
+            if torrent_filepaths:
+                await asyncio.to_thread(self._send_batch_to_tracker, torrent_filepaths, "started")
+            reannounce_task = asyncio.create_task(self._reannounce_periodically())
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                reannounce_task.cancel()
 
         except KeyboardInterrupt:
             # Xử lý khi người dùng nhấn Ctrl+C
@@ -533,9 +856,9 @@ class Peer:
             tqdm.write(f"Error running peer server: {e}")
             logger.exception(f"Error running peer server: {e}")  # Ghi cả traceback
         finally:
-            for stat in self.seeding_torrents.values:
-                self._send_request_to_tracker( torrent_filepath=stat.get("torrent_filepath", ""), 
-                                                event="stopped")
+            torrent_filepaths = [stat.get("torrent_filepath", "") for stat in self.seeding_torrents.values()]
+            if torrent_filepaths:
+                self._send_batch_to_tracker(torrent_filepaths, event="stopped")
 ##################################### DEBUG ###################################################
 def main():
     peer = Peer(peer_port=6881)
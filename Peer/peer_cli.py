@@ -148,15 +148,29 @@ def show_info_cmd(torrent_filepath):
 
 @cli.command()
 @click.option('--port', type=int, default=PEER_PORT, help="Port for peer server")
-def get_torrent(port): #fetch
+@click.option('--search', type=str, default=None, help="Only list torrents whose name contains this text.")
+@click.option('--limit', type=int, default=None, help="Maximum number of torrents to list.")
+@click.option('--cursor', type=str, default=None, help="Continue listing after this info_hash (printed when more results exist).")
+def get_torrent(port, search, limit, cursor): #fetch
     """Download the .torrent file from peer"""
     url = f"http://127.0.0.1:{port}/torrents"
-    request = requests.get(url)
+    params = {key: value for key, value in (("q", search), ("limit", limit), ("cursor", cursor)) if value}
+    request = requests.get(url, params=params)
     request.raise_for_status()
     # Parse and print the response
     data: dict = request.json()['data']
-    rows = [[key, value["name"], value["description"]] for key, value in data.items()]
-    click.echo(tabulate(rows, headers=["info_hash", "Name", "Description"], tablefmt="grid"))
+    swarms: dict = request.json().get('swarms', {})
+    rows = [[key, value["name"], value["description"],
+             swarms.get(key, {}).get("complete", "-"),
+             swarms.get(key, {}).get("incomplete", "-"),
+             swarms.get(key, {}).get("downloaded", "-")] for key, value in data.items()]
+    click.echo(tabulate(rows, headers=["info_hash", "Name", "Description", "Seeders", "Leechers", "Downloaded"], tablefmt="grid"))
+    next_cursor = request.json().get('next_cursor')
+    if next_cursor:
+        click.echo(f"More torrents available, continue with: --cursor {next_cursor}")
+    if not data:
+        click.echo("No torrent found.")
+        return
 
     choices = [(key[:5]+': '+value["name"], key) for key, value in data.items()]
     selected_file = inquirer.select(
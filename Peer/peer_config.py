@@ -4,9 +4,19 @@ import logging
 
 TRACKER_URL = "http://127.0.0.1:8000"
 PIECE_SIZE: int = 256 * 1024
+BLOCK_SIZE: int = 16 * 1024 # Kích thước block mỗi Request yêu cầu; piece được ghép từ nhiều block
 DOWNLOAD_DIR = "G:\Y3S2\MMT\BTL"
 LOG_DIR = "G:\Y3S2\MMT\BTL\BTL1\p2pFileSharingApp"
 INTERVAL = 12
+ANNOUNCE_INTERVAL = 1800 # Chu kỳ announce lại các torrent đang seed để tracker không loại peer
+ANNOUNCE_BATCH_SIZE = 500 # Số torrent tối đa trong một request POST /announce/batch
+PIPELINE_DEPTH = 16 # Số request block tối đa đang chờ trả lời trên mỗi kết nối tải (nên trong khoảng 5-64)
+MAX_QUEUED_REQUESTS = 64 # Số request tối đa seeder nhận trước trên mỗi kết nối khi chưa kịp gửi block
+SUBSCRIBE_TIMEOUT = 30 # Giây mỗi request long-poll GET /peers/subscribe chờ peer mới
+CATALOG_PAGE_SIZE = 100 # Số torrent tối đa mỗi trang GET /torrents của peer server; cả trang được scrape trong một request
+CATALOG_CACHE_SIZE = 8 # Số trang GET /torrents (theo search, limit, cursor) được giữ lại để hỏi lại bằng ETag
+KEEPALIVE_INTERVAL = 5 # Giây giữa hai KeepAlive leecher gửi khi không có request nào để gửi
+KEEPALIVE_TIMEOUT = 120 # Seeder đóng kết nối không gửi message nào (kể cả KeepAlive) trong khoảng này
 
 os.makedirs(LOG_DIR, exist_ok=True)
 log_file_path = os.path.join(LOG_DIR, 'peer_api.log')
@@ -1,25 +1,105 @@
+import asyncio
 import hashlib
 import os
 from enum import Enum
-from typing import Optional, List, Dict
+from typing import Collection, Optional, List, Dict, Set, Tuple
 import aiofiles
 
-from peer_config import LOG_DIR, DOWNLOAD_DIR, get_unique_filename, logger
+from peer_config import LOG_DIR, DOWNLOAD_DIR, BLOCK_SIZE, get_unique_filename, logger
 from peer_torrent import TorrentFile
 from peer_message import *
+from peer_picker import PiecePicker
 
 class PieceStatus(Enum):
     MISSING = 0
     PENDING = 1
     COMPLETED = 2
 
+# Một byte của BitField <-> 8 cờ 0/1 (bit cao nhất ứng với piece có index nhỏ nhất)
+_BYTE_TO_FLAGS = [bytes((value >> (7 - bit)) & 1 for bit in range(8)) for value in range(256)]
+_FLAGS_TO_BYTE = {flags: value for value, flags in enumerate(_BYTE_TO_FLAGS)}
+
+
+def pack_bitfield(flags: bytes) -> bytes:
+    """Payload BitField từ cờ 0/1 của từng piece."""
+    flags = flags + bytes(-len(flags) % 8)
+    return bytes(_FLAGS_TO_BYTE[flags[i:i + 8]] for i in range(0, len(flags), 8))
+
+
+def unpack_bitfield(bitfield: bytes, num_pieces: int) -> bytearray:
+    """Cờ 0/1 của từng piece từ payload BitField nhận được."""
+    if len(bitfield) != -(-num_pieces // 8):
+        raise ValueError(f"BitField of {len(bitfield)} bytes does not match {num_pieces} pieces")
+    return bytearray(b"".join([_BYTE_TO_FLAGS[value] for value in bitfield])[:num_pieces])
+
+
+class PieceBuffer:
+    """
+    Piece đang tải: dữ liệu được ghép từ các block BLOCK_SIZE, mỗi block có thể nhận từ
+    một peer khác nhau. Trạng thái từng block dùng lại PieceStatus (MISSING/PENDING/COMPLETED).
+    """
+    def __init__(self, index: int, size: int):
+        self.index = index
+        self.size = size
+        self.data = bytearray(size)
+        self.blocks: List[PieceStatus] = [PieceStatus.MISSING] * -(-size // BLOCK_SIZE)
+        self.received = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.received == len(self.blocks)
+
+    def block_request(self, block: int) -> Request:
+        begin = block * BLOCK_SIZE
+        return Request(self.index, begin, min(BLOCK_SIZE, self.size - begin))
+
+    def next_block(self, status: PieceStatus) -> Optional[int]:
+        """Block đầu tiên đang ở trạng thái status, hoặc None."""
+        try:
+            return self.blocks.index(status)
+        except ValueError:
+            return None
+
+    def add_block(self, begin: int, block: Buffer) -> bool:
+        """Ghép block vào piece. Trả về False nếu block không khớp ranh giới block hoặc đã nhận rồi."""
+        block_index, offset = divmod(begin, BLOCK_SIZE)
+        if offset or block_index >= len(self.blocks) or len(block) != min(BLOCK_SIZE, self.size - begin):
+            raise ValueError(f"Invalid block (begin={begin}, length={len(block)}) for piece {self.index}")
+        if self.blocks[block_index] == PieceStatus.COMPLETED:
+            return False
+        self.data[begin:begin + len(block)] = block
+        self.blocks[block_index] = PieceStatus.COMPLETED
+        self.received += 1
+        return True
+
+
+class PeerPieces:
+    """Các piece một peer bên kia có (cờ 0/1 theo BitField/Have) và cách peer đó được tính trong PiecePicker."""
+    __slots__ = ("flags", "held", "seed", "counted")
+
+    def __init__(self, num_pieces: int):
+        self.flags = bytearray(num_pieces)
+        self.held: List[int] = []  # Index các piece có cờ 1, để PiecePicker chỉ duyệt các piece này
+        self.seed = False
+        self.counted = False
+
+
 class PieceManage:
     def __init__(self, torrent: TorrentFile, output_dir: str):
         self.torrent: TorrentFile = torrent
         self.completed: bool = False
+        # Được set cùng lúc completed thành True, để vòng tải không phải chờ hết chu kỳ hỏi tracker
+        self.completed_event = asyncio.Event()
         self.pieces_status: List[PieceStatus] = [PieceStatus.MISSING] * self.torrent.number_of_pieces
+        self.pieces_completed: int = 0
+        # Chọn piece mới theo độ hiếm trong các peer đang kết nối
+        self.picker = PiecePicker(self.torrent.number_of_pieces)
         self.haveMultiFile: bool = torrent.is_multifile
         self.active_peers = []
+        # Các piece đang tải dở: {index: PieceBuffer}
+        self.buffers: Dict[int, PieceBuffer] = {}
+        # Kết nối của các peer đang tải piece từ peer này, được báo Have mỗi khi xong một piece
+        self.peer_writers: Set[asyncio.StreamWriter] = set()
         self.output_dir: str = output_dir or DOWNLOAD_DIR
 
         if b"info" not in self.torrent.torrent_data:
@@ -48,18 +128,100 @@ class PieceManage:
             with open(self.output_name, "wb") as f:
                 f.truncate(len)
 
-    def get_request_message(self) -> Optional[Request]:
+    @property
+    def bytes_left(self) -> int:
+        """Số byte chưa tải xong, gửi cho tracker qua tham số left của announce."""
         piece_length = self.torrent.piece_length
-        len = self.total_length if self.haveMultiFile else self.torrent.torrent_data[b"info"][b"length"]
+        missing = self.num_pieces - self.pieces_completed
+        left = missing * piece_length
+        if missing and self.pieces_status[-1] != PieceStatus.COMPLETED:
+            # Piece cuối có thể ngắn hơn piece_length
+            left -= self.num_pieces * piece_length - self.torrent.total_size
+        return left
 
-        for stat in (PieceStatus.MISSING, PieceStatus.PENDING):
-            for index, status in enumerate(self.pieces_status):
-                if status == stat:
-                    self.pieces_status[index] = PieceStatus.PENDING
-                    request_length = len % piece_length if (index == self.torrent.number_of_pieces - 1) else piece_length 
-                    return Request(index, 0, request_length).encode()
+    @property
+    def percent_of_downloaded(self) -> float:
+        return round(100 * self.pieces_completed / self.num_pieces, 2) if self.num_pieces else 100.0
+
+    def bitfield(self) -> bytes:
+        """Payload BitField của các piece đã tải xong."""
+        return pack_bitfield(bytes(status == PieceStatus.COMPLETED for status in self.pieces_status))
+
+    def piece_size(self, index: int) -> int:
+        """Kích thước piece index (piece cuối có thể ngắn hơn piece_length)."""
+        piece_length = self.torrent.piece_length
+        return min(piece_length, self.torrent.total_size - index * piece_length)
+
+    def peer_bitfield(self, peer: PeerPieces, bitfield: bytes):
+        """Cập nhật các piece của peer theo BitField và tính lại độ hiếm."""
+        self.peer_left(peer)
+        peer.flags[:] = unpack_bitfield(bitfield, self.num_pieces)
+        peer.held = [index for index, has in enumerate(peer.flags) if has]
+        peer.seed = self.picker.add_peer(peer.flags)
+        peer.counted = True
+
+    def peer_have(self, peer: PeerPieces, index: int):
+        """Peer báo có thêm piece index (Have)."""
+        if index >= self.num_pieces:
+            raise ValueError(f"Have for invalid piece index {index}")
+        if peer.flags[index]:
+            return
+        peer.flags[index] = 1
+        peer.held.append(index)
+        if not peer.seed:
+            self.picker.add_have(index)
+            peer.counted = True
+
+    def peer_left(self, peer: PeerPieces):
+        """Bỏ các piece của peer khỏi độ hiếm khi ngắt kết nối."""
+        if peer.counted:
+            self.picker.remove_peer(peer.flags, peer.seed)
+            peer.counted = False
+            peer.seed = False
+
+    def _reset_piece(self, index: int):
+        """Piece phải tải lại từ đầu (sai hash, ghi lỗi)."""
+        self.pieces_status[index] = PieceStatus.MISSING
+        self.picker.push(index)
+
+    def get_request_message(self, skip: Collection[Tuple[int, int]] = (),
+                            peer: Optional[PeerPieces] = None) -> Optional[Request]:
+        """
+        Request cho block tiếp theo cần tải. Block còn thiếu của các piece đang tải dở được ưu tiên
+        để nhiều peer cùng tải một piece và piece sớm hoàn thành; sau đó mới mở piece mới, hiếm nhất
+        trong các peer đang kết nối (PiecePicker). Khi mọi block đều đã được yêu cầu, block PENDING
+        được yêu cầu lại từ peer khác (giai đoạn cuối).
+        skip: các (index, begin) kết nối hiện tại đang chờ, không yêu cầu lại ở giai đoạn cuối.
+        peer: các piece peer bên kia có; None là có tất cả.
+        """
+        available = None if peer is None or peer.seed else peer.flags
+        for buffer in self.buffers.values():
+            if available is not None and not available[buffer.index]:
+                continue
+            block = buffer.next_block(PieceStatus.MISSING)
+            if block is not None:
+                buffer.blocks[block] = PieceStatus.PENDING
+                return buffer.block_request(block)
+        index = self.picker.pick(available, None if available is None else peer.held)
+        if index is not None:
+            self.pieces_status[index] = PieceStatus.PENDING
+            buffer = self.buffers[index] = PieceBuffer(index, self.piece_size(index))
+            buffer.blocks[0] = PieceStatus.PENDING
+            return buffer.block_request(0)
+        for buffer in self.buffers.values():
+            if available is not None and not available[buffer.index]:
+                continue
+            for block, status in enumerate(buffer.blocks):
+                if status == PieceStatus.PENDING and (buffer.index, block * BLOCK_SIZE) not in skip:
+                    return buffer.block_request(block)
         return None
 
+    def release_request(self, request: Request):
+        """Trả block của một request chưa được trả lời (peer ngắt kết nối) về MISSING để peer khác tải."""
+        buffer = self.buffers.get(request.index)
+        block = request.begin // BLOCK_SIZE
+        if buffer and block < len(buffer.blocks) and buffer.blocks[block] == PieceStatus.PENDING:
+            buffer.blocks[block] = PieceStatus.MISSING
 
     # def _prepare_output(self):
     #     if self.haveMultiFile:
@@ -160,54 +322,44 @@ class PieceManage:
                 # self.pieces_status[index] = PieceStatus.COMPLETED
             # logger.info(f"Written {len(data)} bytes to {self.output_name}")
 
-    async def receive_piece(self, data : bytes):
-        """Xử lý dữ liệu piece nhận được từ peer."""
-        # <message ID> = 1 byte(value = 7)
-        # <index> = int = 4 byte
-        # <begin> = int = 4 byte
-        # <block> = data sent
-        if len(data) < 9:
-            raise Exception("PeerManage::receive_piece::Received piece data is too short.")
-        # id, index, begin = struct.unpack(f'>bII', data[:9])
-        id = data[0]
-        index = struct.unpack('>I', data[1:5])[0]
-        begin = struct.unpack('>I', data[5:9])[0]
-        # logger.info(f"Received piece data: id={id}, index={index}, begin={begin}")
+    async def receive_piece(self, piece: Piece):
+        """
+        Xử lý một block nhận được từ peer. Khi piece đủ block thì kiểm tra hash và ghi vào file.
+        Trả về index của piece vừa hoàn thành, None nếu piece chưa đủ block.
+        """
+        index, begin = piece.index, piece.begin
         if index < 0 or index >= self.torrent.number_of_pieces:
             raise Exception(f"PeerManage::receive_piece::Invalid piece index received: {index}")
-        recv_data = data[9:]
-        # logger.info(f"From received_piece: Received piece {index} with block length {len(recv_data)} bytes")
-        if id != PeerMessage.Piece:
-            raise Exception("Received an invalid piece data, id != PeerMessage.Piece")
-        if not self.validate_received_piece(recv_data, index):
-            raise Exception("Received an invalid piece data, validate_received_piece(recv_data, index)")
-        if self.pieces_status[index] == PieceStatus.COMPLETED:
-            logger.info(f"Received piece {index} which is already completed. Ignoring.")
+        buffer = self.buffers.get(index)
+        if self.pieces_status[index] == PieceStatus.COMPLETED or buffer is None:
+            logger.debug(f"Received block {begin} of piece {index} which is not being downloaded. Ignoring.")
+            return None
+        if not buffer.add_block(begin, piece.block) or not buffer.complete:
             return None
 
+        del self.buffers[index]
+        if not self.validate_received_piece(buffer.data, index):
+            self._reset_piece(index)
+            raise Exception("Received an invalid piece data, validate_received_piece(buffer.data, index)")
         #ghi vao file
         try:
-            await self.write_piece_to_file(index, recv_data)
+            await self.write_piece_to_file(index, buffer.data)
             self.pieces_status[index] = PieceStatus.COMPLETED
-            self.completed = all([x == PieceStatus.COMPLETED for x in self.pieces_status])
-            for x in self.pieces_status:
-                logger.info(f"Piece status: {x}")
+            self.pieces_completed += 1
+            self.completed = self.pieces_completed == self.num_pieces
             logger.info(f"Successfully received and saved piece {index}.")
+            have = Have(index).encode()
+            for writer in self.peer_writers:
+                writer.write(have)
             if self.completed:
+                self.completed_event.set()
                 logger.info("All pieces have been downloaded!")
             return index #tra ve index bao hieu thanh cong
+        except asyncio.CancelledError:
+            # Kết nối bị đóng giữa lúc ghi: piece phải được tải lại
+            self._reset_piece(index)
+            raise
         except Exception as e:
+            self._reset_piece(index)
             logger.error(f"receive_piece::Unexpected error with piece {index}: {str(e)}", exc_info=True)
             return None #ghi khong thanh cong
-
-
-
-    
-
-
-
-
-
-
-
-        
\ No newline at end of file
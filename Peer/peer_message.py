@@ -1,5 +1,12 @@
-from peer_config import PIECE_SIZE
+from peer_config import BLOCK_SIZE
+import asyncio
 import struct
+from typing import Dict, Optional, Tuple, Type, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Largest message accepted from a peer (a 16 KiB Piece, or the BitField of a ~1 million piece torrent)
+MAX_MESSAGE_LENGTH = 1 << 17
 
 
 class PeerMessage:
@@ -22,12 +29,35 @@ class PeerMessage:
     Handshake = None  # Handshake is not really part of the messages
     KeepAlive = None  # Keep-alive has no ID according to spec
 
+    id: Optional[int] = None
+    payload_size = 0  # Fixed part of the payload after the message ID; shorter payloads are rejected
+
     def encode(self) -> bytes:
-        pass
+        return b"".join(self.encode_parts())
+
+    def encode_parts(self) -> Tuple[Buffer, ...]:
+        """
+        The message as a tuple of buffers (header first) for StreamWriter.writelines,
+        so a large payload is handed to the transport without being copied into a new message.
+        """
+        return struct.pack('>Ib', 1, self.id),
 
     @classmethod
-    def decode(cls, data: bytes):
-        pass
+    def decode(cls, data: Buffer):
+        """Decodes a complete message, including its 4 byte length prefix."""
+        return cls.parse(memoryview(data)[5:])
+
+    @classmethod
+    def parse(cls, payload: memoryview):
+        """from_payload after checking the payload length, raises ValueError for a truncated message."""
+        if len(payload) < cls.payload_size:
+            raise ValueError(f"{cls.__name__} payload of {len(payload)} bytes is shorter than {cls.payload_size} bytes")
+        return cls.from_payload(payload)
+
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        """Builds the message from the bytes following the message ID."""
+        return cls()
 
 class Handshake(PeerMessage):
     """
@@ -80,47 +110,125 @@ class Handshake(PeerMessage):
         return True
 
 
+class KeepAlive(PeerMessage):
+    """
+    Message format:
+        <len=0000>
+    """
+
+    def encode_parts(self) -> Tuple[Buffer, ...]:
+        return b"\x00\x00\x00\x00",
+
+
+class Choke(PeerMessage):
+    """<len=0001><id=0>"""
+    id = PeerMessage.Choke
+
+
+class Unchoke(PeerMessage):
+    """<len=0001><id=1>"""
+    id = PeerMessage.Unchoke
+
+
+class Interested(PeerMessage):
+    """<len=0001><id=2>"""
+    id = PeerMessage.Interested
+
+
+class NotInterested(PeerMessage):
+    """<len=0001><id=3>"""
+    id = PeerMessage.NotInterested
+
+
+class Have(PeerMessage):
+    """
+    Announces that the sender has completed (and verified) a piece.
+    Message format:
+        <len=0005><id=4><piece index>
+    """
+    id = PeerMessage.Have
+    payload_size = 4
+
+    def __init__(self, index: int):
+        self.index = index
+
+    def encode_parts(self) -> Tuple[Buffer, ...]:
+        return struct.pack('>IbI', 5, PeerMessage.Have, self.index),
+
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        return cls(struct.unpack_from('>I', payload)[0])
+
+
+class BitField(PeerMessage):
+    """
+    The pieces the sender has, sent right after the handshake.
+    The high bit of the first byte is piece 0; spare bits at the end are zero.
+    Message format:
+        <len=0001+X><id=5><bitfield>
+    """
+    id = PeerMessage.BitField
+
+    def __init__(self, bitfield: bytes):
+        self.bitfield = bitfield
+
+    def encode_parts(self) -> Tuple[Buffer, ...]:
+        return struct.pack('>Ib', 1 + len(self.bitfield), PeerMessage.BitField), self.bitfield
+
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        return cls(bytes(payload))
+
+
 class Request(PeerMessage):
     """
     The message used to request a block of a piece (i.e. a partial piece).
-    The request size for each block is 256KB
+    The request size for each block is 16KB (BLOCK_SIZE), the last block of a piece may be shorter.
     Message format:
         <len=0013><id=6><index><begin><length>
     """
+    id = PeerMessage.Request
+    payload_size = 12
 
-    def __init__(self, index: int, begin: int, length: int = PIECE_SIZE):
+    def __init__(self, index: int, begin: int, length: int = BLOCK_SIZE):
         """
         :param index: The zero based piece index
         :param begin: The zero based offset within a piece
-        :param length: The requested length of data (default 256kB)
+        :param length: The requested length of data (default 16kB)
         """
         self.index = index
         self.begin = begin
         self.length = length
 
-    def encode(self):
-        return struct.pack('>IbIII',
-                           13,
-                           PeerMessage.Request,
-                           self.index,
-                           self.begin,
-                           self.length)
+    def encode_parts(self) -> Tuple[Buffer, ...]:
+        return struct.pack('>IbIII', 13, self.id, self.index, self.begin, self.length),
 
     @classmethod
-    def decode(cls, data: bytes):
-        # Tuple with (message length, id, index, begin, length)
-        parts = struct.unpack('>IbIII', data)
-        return cls(parts[2], parts[3], parts[4])
+    def from_payload(cls, payload: memoryview):
+        return cls(*struct.unpack_from('>III', payload))
+
+
+class Cancel(Request):
+    """
+    Cancels a previously sent Request (used when the block arrived from another peer).
+    Message format:
+        <len=0013><id=8><index><begin><length>
+    """
+    id = PeerMessage.Cancel
 
 
 class Piece(PeerMessage):
     """
     Message format:
         <length prefix><message ID><index><begin><block>
+    The block may be a memoryview into the receive buffer of a MessageReader,
+    it is only valid until the next read() on that reader.
     """
+    id = PeerMessage.Piece
     length = 9 #The Piece message length without the block data
+    payload_size = 8
 
-    def __init__(self, index: int, begin: int, block: bytes):
+    def __init__(self, index: int, begin: int, block: Buffer):
         """
         :param index: The zero based piece index
         :param begin: The zero based offset within a piece
@@ -130,19 +238,76 @@ class Piece(PeerMessage):
         self.begin = begin
         self.block = block
 
-    def encode(self):
-        message_length = Piece.length + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's',
-                           message_length,
-                           PeerMessage.Piece,
-                           self.index,
-                           self.begin,
-                           self.block)
+    def encode_parts(self) -> Tuple[Buffer, ...]:
+        header = struct.pack('>IbII', Piece.length + len(self.block), PeerMessage.Piece, self.index, self.begin)
+        return header, self.block
 
     @classmethod
-    def decode(cls, data: bytes):
-        length = struct.unpack('>I', data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's',
-                              data[:length + 4])
-        return cls(parts[2], parts[3], parts[4])
+    def from_payload(cls, payload: memoryview):
+        index, begin = struct.unpack_from('>II', payload)
+        return cls(index, begin, payload[8:])
+
+
+MESSAGE_TYPES: Dict[int, Type[PeerMessage]] = {
+    message_type.id: message_type
+    for message_type in (Choke, Unchoke, Interested, NotInterested, Have, BitField, Request, Piece, Cancel)
+}
+
 
+class MessageReader:
+    """
+    Incremental framer for the messages following the handshake.
+    Data from the stream is collected in one reusable bytearray; each message is parsed from
+    a memoryview of it, so a Piece block reaches the piece buffer without intermediate copies.
+    Messages must be handled before the next read(): the buffer is reused by then.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, max_length: int = MAX_MESSAGE_LENGTH):
+        self._reader = reader
+        self.max_length = max_length
+        self._buffer = bytearray(4 + max_length)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Start of the first unparsed message
+        self._end = 0  # End of the received data
+
+    def _next_frame(self) -> Optional[memoryview]:
+        """The next complete message without its length prefix, or None if it has not fully arrived."""
+        available = self._end - self._start
+        if available < 4:
+            return None
+        length = int.from_bytes(self._view[self._start:self._start + 4], "big")
+        if length > self.max_length:
+            raise ValueError(f"Message of {length} bytes exceeds the limit of {self.max_length} bytes")
+        if available < 4 + length:
+            return None
+        frame = self._view[self._start + 4:self._start + 4 + length]
+        self._start += 4 + length
+        return frame
+
+    async def read(self) -> PeerMessage:
+        """
+        The next message. Messages with unsupported IDs (e.g. Port) are skipped.
+        Raises asyncio.IncompleteReadError if the connection closes mid-message,
+        ValueError for a message that is too long or too short for its type.
+        """
+        while True:
+            frame = self._next_frame()
+            if frame is not None:
+                if not frame:
+                    return KeepAlive()
+                message_type = MESSAGE_TYPES.get(frame[0])
+                if message_type is not None:
+                    return message_type.parse(frame[1:])
+                continue
+            if self._start == self._end:
+                self._start = self._end = 0
+            elif self._end == len(self._buffer):
+                # Move the partially received message to the front of the buffer
+                remaining = self._end - self._start
+                self._view[:remaining] = self._view[self._start:self._end]
+                self._start, self._end = 0, remaining
+            chunk = await self._reader.read(len(self._buffer) - self._end)
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(self._view[self._start:self._end]), None)
+            self._view[self._end:self._end + len(chunk)] = chunk
+            self._end += len(chunk)
@@ -0,0 +1,127 @@
+import random
+from typing import List, Optional, Sequence
+
+
+class PiecePicker:
+    """
+    Chọn piece tiếp theo theo thứ tự hiếm nhất trước (rarest-first).
+    Các piece chưa bắt đầu tải được chia vào bucket theo số peer đang kết nối có piece đó;
+    mỗi bucket là một list không thứ tự kèm vị trí của từng piece nên thêm/bỏ/chuyển bucket
+    đều O(1) (xóa bằng cách đổi chỗ với phần tử cuối). Piece trong cùng bucket được chọn ngẫu nhiên
+    để các peer trong swarm không cùng tranh một piece.
+    Seeder có mọi piece nên không làm thay đổi thứ tự hiếm: chúng chỉ được đếm trong seeds,
+    không cần cập nhật từng piece.
+    Với peer chỉ có một phần các piece, pick duyệt danh sách piece của peer đó khi nó ngắn hơn
+    số piece đang chờ, nên mỗi lần chọn tốn O(min(số piece peer có, số piece đang chờ)).
+    """
+
+    def __init__(self, num_pieces: int):
+        # Số peer (không tính seeder) có từng piece
+        self.availability: List[int] = [0] * num_pieces
+        self.seeds = 0
+        self._buckets: List[List[int]] = [list(range(num_pieces))]
+        # Vị trí của piece trong bucket availability[index], -1 nếu piece không chờ được chọn
+        self._positions: List[int] = list(range(num_pieces))
+        self.waiting = num_pieces  # Số piece đang chờ được chọn
+
+    def _remove(self, index: int):
+        bucket = self._buckets[self.availability[index]]
+        position = self._positions[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self._positions[last] = position
+        self._positions[index] = -1
+        self.waiting -= 1
+
+    def _insert(self, index: int):
+        count = self.availability[index]
+        while len(self._buckets) <= count:
+            self._buckets.append([])
+        bucket = self._buckets[count]
+        self._positions[index] = len(bucket)
+        bucket.append(index)
+        self.waiting += 1
+
+    def _change(self, index: int, delta: int):
+        waiting = self._positions[index] >= 0
+        if waiting:
+            self._remove(index)
+        self.availability[index] += delta
+        if waiting:
+            self._insert(index)
+
+    def add_peer(self, flags: Sequence[int]) -> bool:
+        """Tính các piece của một peer mới (cờ 0/1 theo BitField). Trả về True nếu peer là seeder."""
+        if all(flags):
+            self.seeds += 1
+            return True
+        for index, has in enumerate(flags):
+            if has:
+                self._change(index, 1)
+        return False
+
+    def remove_peer(self, flags: Sequence[int], seed: bool):
+        """Bỏ một peer đã ngắt kết nối; seed phải là giá trị add_peer đã trả về cho peer đó."""
+        if seed:
+            self.seeds -= 1
+            return
+        for index, has in enumerate(flags):
+            if has:
+                self._change(index, -1)
+
+    def add_have(self, index: int):
+        """Peer (không phải seeder) báo vừa có thêm piece index."""
+        self._change(index, 1)
+
+    def pick(self, available: Optional[Sequence[int]] = None,
+             held: Optional[Sequence[int]] = None) -> Optional[int]:
+        """
+        Lấy piece hiếm nhất mà peer bên kia có (available là cờ 0/1 của peer đó, None nếu peer có mọi piece;
+        held là danh sách index các piece peer đó có), bỏ nó khỏi danh sách chờ.
+        Trả về None nếu không có piece phù hợp.
+        """
+        if available is not None and held is not None and len(held) < self.waiting:
+            return self._pick_held(held)
+        # Piece availability 0 chỉ seeder có, peer không phải seeder không thể có
+        first = 0 if available is None else 1
+        for bucket in self._buckets[first:]:
+            if not bucket:
+                continue
+            start = random.randrange(len(bucket))
+            if available is None:
+                index = bucket[start]
+                self._remove(index)
+                return index
+            for offset in range(len(bucket)):
+                index = bucket[(start + offset) % len(bucket)]
+                if available[index]:
+                    self._remove(index)
+                    return index
+        return None
+
+    def _pick_held(self, held: Sequence[int]) -> Optional[int]:
+        """pick() duyệt các piece của peer: piece đang chờ có availability nhỏ nhất, chọn ngẫu nhiên khi bằng nhau."""
+        best = None
+        best_count = 0
+        ties = 0
+        for index in held:
+            if self._positions[index] < 0:
+                continue
+            count = self.availability[index]
+            if not count:
+                continue  # Như pick(): piece availability 0 chỉ seeder có
+            if best is None or count < best_count:
+                best, best_count, ties = index, count, 1
+            elif count == best_count:
+                ties += 1
+                if random.randrange(ties) == 0:
+                    best = index
+        if best is not None:
+            self._remove(best)
+        return best
+
+    def push(self, index: int):
+        """Đưa piece trở lại danh sách chờ (piece sai hash hoặc ghi lỗi phải tải lại)."""
+        if self._positions[index] < 0:
+            self._insert(index)
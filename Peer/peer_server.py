@@ -121,8 +121,17 @@ async def start_seed_torrent():
 @app.route("/torrents", methods=["GET"])
 async def get_torrents():
     try:
-        torrents = Peer.get_torrents()
-        return jsonify({"data": torrents}), 200
+        # Luôn lấy một trang có giới hạn để chỉ phải scrape swarm của các torrent trên trang đó
+        limit = min(request.args.get("limit", type=int) or CATALOG_PAGE_SIZE, CATALOG_PAGE_SIZE)
+        torrents, next_cursor = Peer.get_torrents_page(search=request.args.get("q"),
+                                                       limit=limit,
+                                                       cursor=request.args.get("cursor"))
+        try:
+            swarms = Peer.scrape(list(torrents), batch_size=CATALOG_PAGE_SIZE)
+        except Exception as e:
+            logger.warning(f"Could not scrape swarm sizes from tracker: {e}")
+            swarms = {}
+        return jsonify({"data": torrents, "swarms": swarms, "next_cursor": next_cursor}), 200
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -0,0 +1,90 @@
+import ipaddress
+import os
+import socket
+import struct
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from peer_config import logger
+
+PROTOCOL_ID = 0x41727101980 # Magic constant của BEP 15
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_ERROR = 3
+EVENTS = {None: 0, "completed": 1, "started": 2, "stopped": 3}
+UDP_TIMEOUT = 5 # Giây chờ phản hồi cho mỗi lần gửi
+UDP_RETRIES = 3
+
+
+def _transaction(sock: socket.socket, address, action: int, payload: bytes,
+                 connection_id: int) -> bytes:
+    """
+    Gửi một request UDP tracker và chờ phản hồi có cùng transaction_id.
+    Trả về phần thân phản hồi (sau action và transaction_id).
+    """
+    transaction_id = struct.unpack(">I", os.urandom(4))[0]
+    packet = struct.pack(">QII", connection_id, action, transaction_id) + payload
+    for attempt in range(UDP_RETRIES):
+        sock.sendto(packet, address)
+        try:
+            while True:
+                data, _ = sock.recvfrom(65536)
+                if len(data) < 8:
+                    continue
+                recv_action, recv_transaction_id = struct.unpack(">II", data[:8])
+                if recv_transaction_id != transaction_id:
+                    continue
+                if recv_action == ACTION_ERROR:
+                    raise RuntimeError(f"UDP tracker error: {data[8:].decode('utf-8', 'replace')}")
+                if recv_action != action:
+                    raise RuntimeError(f"UDP tracker replied with unexpected action {recv_action}")
+                return data[8:]
+        except socket.timeout:
+            logger.warning(f"Timeout waiting UDP tracker {address} (attempt {attempt + 1}/{UDP_RETRIES})")
+    raise TimeoutError(f"UDP tracker {address} did not respond")
+
+
+def udp_announce(tracker_url: str, info_hash: bytes, peer_id: bytes, port: int,
+                 ip: Optional[str] = None, event: Optional[str] = None,
+                 left: int = 0, numwant: int = -1) -> Dict[str, Any]:
+    """
+    Announce tới UDP tracker theo BEP 15 (connect rồi announce).
+    Returns: {"interval": <giây>, "peers": [{"ip": ip, "port": port}, ...]}, cùng dạng
+    với Peer._decode_announce_reply để phần còn lại của peer không cần phân biệt HTTP/UDP.
+    """
+    url = urlparse(tracker_url)
+    address = (url.hostname, url.port)
+    packed_ip = 0
+    if ip:
+        try:
+            address_ip = ipaddress.ip_address(ip)
+            if address_ip.version == 4:
+                packed_ip = int(address_ip)
+        except ValueError:
+            pass
+    family = socket.AF_INET6 if ":" in url.hostname else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(UDP_TIMEOUT)
+        body = _transaction(sock, address, ACTION_CONNECT, b"", PROTOCOL_ID)
+        connection_id = struct.unpack(">Q", body[:8])[0]
+        payload = struct.pack(">20s20sQQQIIIiH",
+                              info_hash,
+                              peer_id[:20],
+                              0,                # downloaded
+                              left,
+                              0,                # uploaded
+                              EVENTS.get(event, 0),
+                              packed_ip,
+                              0,                # key
+                              numwant,
+                              port)
+        body = _transaction(sock, address, ACTION_ANNOUNCE, payload, connection_id)
+    interval, _leechers, _seeders = struct.unpack(">III", body[:12])
+    raw = body[12:]
+    ip_length = 16 if family == socket.AF_INET6 else 4
+    step = ip_length + 2
+    peers = [{
+        "ip": socket.inet_ntop(family, raw[offset:offset + ip_length]),
+        "port": int.from_bytes(raw[offset + ip_length:offset + step], "big")
+    } for offset in range(0, len(raw) - step + 1, step)]
+    return {"interval": interval, "peers": peers}
@@ -1,34 +1,92 @@
+import asyncio
+import base64
+import hashlib
+import hmac
 import json
 import logging
+import math
 import os
+import time
 import uuid
+import bencodepy
 import click
+import requests
 import uvicorn
 
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from urllib.parse import quote
 from werkzeug.utils import secure_filename
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Set, Tuple
 from fastapi import FastAPI, Request, File, UploadFile, Form, Query, HTTPException, status
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+from pydantic import BaseModel
+from tracker_logging import parse_sample_rates, setup_logging
+from tracker_metrics import MetricsMiddleware, MetricsRegistry
+from tracker_cluster import Cluster
+from tracker_catalog import TorrentCatalog, TorrentFileCache, etag_matches, make_etag
+from tracker_storage import JsonStorage, PeerChanges, SQLiteStorage, Storage
+from tracker_swarm import Bucket, Locality, PackedPeers, PeerKey, PeerSelection, Swarm, parse_site_prefixes
+from tracker_udp import UDPTrackerProtocol
+from tracker_watch import SwarmWatcher
 # from Peer.config import
 
+# Cấu hình chạy được đọc từ biến môi trường để mọi worker process (--workers) dùng chung cấu hình với main()
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-LOG_DIR = "G:\Y3S2\MMT\BTL\BTL1\p2pFileSharingApp"
-TORRENT_DIR = os.path.join(BASE_DIR, "tracker_torrents") # Thư mục lưu file .torrent
-PEER_FILE = os.path.join(BASE_DIR, "tracker_peers.json") # File lưu danh sách peers theo info_hash
-TORRENT_FILE = os.path.join(BASE_DIR, "tracker_torrents.json") # File lưu metadata torrent
+LOG_DIR = os.environ.get("TRACKER_LOG_DIR", "G:\Y3S2\MMT\BTL\BTL1\p2pFileSharingApp")
+LOG_LEVEL = os.environ.get("TRACKER_LOG_LEVEL", "INFO")
+# Tỉ lệ giữ lại log của các sự kiện lặp lại nhiều, ví dụ "announce=0.01,upload=1"
+LOG_SAMPLE = os.environ.get("TRACKER_LOG_SAMPLE", "")
+DATA_DIR = os.environ.get("TRACKER_DATA_DIR", BASE_DIR) # Thư mục dữ liệu; mỗi tracker chạy trên cùng máy cần một thư mục riêng
+TORRENT_DIR = os.path.join(DATA_DIR, "tracker_torrents") # Thư mục lưu file .torrent
+PEER_FILE = os.path.join(DATA_DIR, "tracker_peers.json") # File lưu danh sách peers theo info_hash
+TORRENT_FILE = os.path.join(DATA_DIR, "tracker_torrents.json") # File lưu metadata torrent
+DB_FILE = os.environ.get("TRACKER_DB", os.path.join(DATA_DIR, "tracker.db")) # Database của backend lưu trữ "sqlite"
+STORAGE_BACKEND = os.environ.get("TRACKER_STORAGE", "json") # "json" (TORRENT_FILE + PEER_FILE) hoặc "sqlite" (DB_FILE)
+WORKERS = int(os.environ.get("TRACKER_WORKERS", "1")) # Số worker process; > 1 cần STORAGE_BACKEND = "sqlite"
+SYNC_INTERVAL = 1 # Giây giữa hai lần ghi/đọc thay đổi của các worker khác khi WORKERS > 1
 ANNOUNCE_INTERVAL = 1800 # Giây (30 phút)
+MIN_ANNOUNCE_INTERVAL = 30 # "min interval": announce định kỳ sớm hơn khoảng này không được xử lý lại
+RESPONSE_CACHE_TTL = 10 # Giây dùng lại một mẫu peer đã chọn (và đã mã hoá) của swarm lớn cho các announce sau
+FLUSH_INTERVAL = 5 # Giây giữa hai lần ghi snapshot peers xuống PEER_FILE
+PEER_TTL = 2 * ANNOUNCE_INTERVAL # Peer không announce lại trong khoảng này sẽ bị loại khỏi swarm
+SWEEP_INTERVAL = 60 # Giây giữa hai lần dọn peer hết hạn
+UDP_ADDRESS: Optional[Tuple[str, int]] = None # (host, port) cho UDP tracker (BEP 15), None để tắt
+if os.environ.get("TRACKER_UDP_ADDRESS"):
+    _udp_host, _, _udp_port = os.environ["TRACKER_UDP_ADDRESS"].rpartition(":")
+    UDP_ADDRESS = (_udp_host, int(_udp_port))
+# Chế độ cluster: URL của mọi node (cùng thứ tự trên mọi node, phân cách bằng dấu phẩy) và vị trí của node này
+CLUSTER_NODES = [node for node in os.environ.get("TRACKER_CLUSTER", "").split(",") if node]
+CLUSTER_NODE = int(os.environ.get("TRACKER_NODE", "0"))
+# Secret chung của các node, gửi trong header CLUSTER_SECRET_HEADER; /cluster/replicate và /cluster/torrents
+# từ chối request không có secret đúng
+CLUSTER_SECRET = os.environ.get("TRACKER_CLUSTER_SECRET", "")
+CLUSTER_SECRET_HEADER = "X-Tracker-Cluster-Secret"
+REPLICATION_INTERVAL = 1 # Giây giữa hai lần gửi thay đổi swarm sang replica
+HEARTBEAT_INTERVAL = 2 # Giây giữa hai lần kiểm tra các node khác còn sống
+CLUSTER_TIMEOUT = 5 # Timeout (giây) của request giữa các node
+MAX_TORRENT_BROADCAST = 100 # Số torrent tối đa gửi sang một node trong mỗi lần
+# Prefix mạng của các site, ví dụ "hn=10.1.0.0/16,hcm=10.2.0.0/16": peer cùng site được ưu tiên sau cùng /24, /16
+SITE_PREFIXES = os.environ.get("TRACKER_SITE_PREFIXES", "")
+# Tỉ lệ peer trong mỗi phản hồi announce được chọn ngẫu nhiên trong cả swarm thay vì ưu tiên peer gần người hỏi
+LOCALITY_RANDOM_FRACTION = float(os.environ.get("TRACKER_LOCALITY_RANDOM", "0.25"))
+DEFAULT_NUMWANT = 50 # Số peer trả về mặc định cho mỗi announce
+MAX_NUMWANT = 200 # Giới hạn trên của tham số numwant
+ANNOUNCE_EVENTS = ("started", "completed", "stopped") # Event có nhãn riêng trong tracker_announces_total
+MAX_BATCH_ANNOUNCES = 1000 # Số announce tối đa trong một request POST /announce/batch
+SUBSCRIBE_TIMEOUT = 30 # Giây mặc định một request GET /peers/subscribe chờ thay đổi
+MAX_SUBSCRIBE_TIMEOUT = 60 # Giới hạn trên của tham số timeout
+MAX_CATALOG_PAGE = 1000 # Số torrent tối đa trong một trang GET /torrents
+TORRENT_CACHE_BYTES = 64 * 1024 * 1024 # Dung lượng tối đa của cache nội dung file .torrent
+MAX_TORRENT_SIZE = 4 * 1024 * 1024 # Kích thước tối đa của một file .torrent được upload
+MAX_UPLOAD_BODY = MAX_TORRENT_SIZE + 64 * 1024 # Body tối đa của POST /announce: file cộng các trường form và boundary
+UPLOAD_CHUNK_SIZE = 64 * 1024 # Đọc file upload theo từng khối này
 
 os.makedirs(TORRENT_DIR, exist_ok=True)
 
 # --- Cấu hình logging ---
 log_file_path = os.path.join(LOG_DIR, 'tracker.log')
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8')
-    ]
-)
+log_handler = setup_logging(log_file_path, LOG_LEVEL, parse_sample_rates(LOG_SAMPLE))
 logger = logging.getLogger("TorrentTracker")
 # --- Kết thúc cấu hình logging ---
 
@@ -43,73 +101,872 @@ if not os.path.exists(PEER_FILE):
         json.dump({}, f)
     logger.info(f"Initialized empty peer file: {PEER_FILE}")
 
-app = FastAPI()
-peers = {}  # Dictionary lưu danh sách peers, ví dụ: {info_hash: [{"ip": ip, "port": port}, ...]}
+# Registry peers trong bộ nhớ, là nguồn dữ liệu chính của tracker:
+# {info_hash: Swarm}. Storage chỉ nhận các thay đổi được ghi định kỳ.
+peers: Dict[str, Swarm] = {}
+# Thay đổi của registry chưa được ghi xuống storage: {(info_hash, peer_key): seed hoặc None nếu đã xoá}
+peer_changes: PeerChanges = {}
+flush_lock = asyncio.Lock()
+# Ghi danh mục torrent xuống storage lần lượt: snapshot mới nhất luôn được ghi sau cùng
+torrents_lock = asyncio.Lock()
+storage: Optional[Storage] = None
+# Thời điểm announce gần nhất của từng peer: {(info_hash, (ip, port)): time.monotonic()}.
+# Luôn được giữ theo thứ tự last_seen tăng dần (move_to_end mỗi lần announce),
+# nên peer hết hạn luôn nằm ở đầu và việc dọn dẹp chỉ tốn O(số peer hết hạn).
+last_seen: "OrderedDict[Tuple[str, PeerKey], float]" = OrderedDict()
+# Số lần event "completed" của từng swarm (giá trị "downloaded" khi scrape).
+# Giữ riêng vì swarm bị xoá khi không còn peer nhưng số lượt tải xong vẫn phải còn.
+downloads: Dict[str, int] = {}
+# Danh sách peer đã chọn và mã hoá sẵn của từng swarm, dùng lại cho nhiều announce (xem select_peers):
+# {info_hash: {nhóm mạng hoặc None: (swarm.version hoặc None, hết hạn lúc (monotonic), số peer được yêu cầu, PackedPeers)}}
+response_cache: Dict[str, Dict[Optional[Bucket], Tuple[Optional[int], float, int, PackedPeers]]] = {}
+NO_PEERS = PackedPeers(()).select(0)
+# Nhóm mạng (/24, /16, site) của peer, tính một lần khi peer vào swarm
+locality = Locality(parse_site_prefixes(SITE_PREFIXES))
+# Peer vào/rời từng swarm, cho các leecher theo dõi qua GET /peers/subscribe
+watcher = SwarmWatcher()
+# Cấu hình cluster, None khi tracker chạy một mình
+cluster: Optional[Cluster] = Cluster(CLUSTER_NODES, CLUSTER_NODE) if CLUSTER_NODES else None
+# Thay đổi của các swarm thuộc vùng của node này chưa gửi sang replica
+replication_changes: PeerChanges = {}
+# False khi replica chưa có (hoặc có thể đã mất) trạng thái vùng của node này: lần gửi tới sẽ gửi cả vùng
+replica_synced = False
+# Thay đổi node này nhận thay cho node sở hữu đang down, chờ trả lại khi node đó lên lại: {node: changes}
+failover_changes: Dict[int, PeerChanges] = {}
+# Torrent mới upload chưa gửi được tới các node khác: {node: {info_hash}}
+pending_torrents: Dict[int, Set[str]] = {}
+# Danh mục torrent trong bộ nhớ, nạp từ TORRENT_FILE khi khởi động và ghi lại mỗi lần announce_post thay đổi
+catalog = TorrentCatalog()
+# Nội dung các file .torrent được tải gần đây, để nhiều leecher cùng lấy một torrent không phải đọc đĩa
+torrent_cache = TorrentFileCache(TORRENT_CACHE_BYTES)
+
+# --- Metrics (GET /metrics, Prometheus text format) ---
+# Mỗi worker process có bộ metric riêng; gauge chỉ được tính khi /metrics được gọi.
+metrics = MetricsRegistry()
+http_requests_total = metrics.counter("tracker_http_requests_total",
+                                      "HTTP requests by route, method and status code",
+                                      ("route", "method", "status"))
+http_request_duration = metrics.histogram("tracker_http_request_duration_seconds",
+                                          "HTTP request latency by route", ("route",))
+announces_total = metrics.counter("tracker_announces_total", "Announces (HTTP and UDP) by event", ("event",))
+throttled_announces_total = metrics.counter("tracker_announces_throttled_total",
+                                            "Regular announces received before min interval (registry left untouched)")
+response_cache_hits_total = metrics.counter("tracker_announce_response_cache_hits_total",
+                                            "Announces answered from a cached pre-encoded peer list")
+response_cache_misses_total = metrics.counter("tracker_announce_response_cache_misses_total",
+                                              "Announces that had to select and encode a new peer list")
+metrics.gauge("tracker_announce_response_cache_hit_ratio", "Share of announces answered from the response cache",
+              lambda: response_cache_hits_total.values[()] /
+              max(1, response_cache_hits_total.values[()] + response_cache_misses_total.values[()]))
+flush_duration = metrics.histogram("tracker_storage_flush_duration_seconds",
+                                   "Time spent writing a batch of peer changes to storage")
+flush_errors_total = metrics.counter("tracker_storage_flush_errors_total", "Failed peer storage flushes")
+metrics.gauge("tracker_swarms", "Swarms with at least one peer", lambda: len(peers))
+metrics.gauge("tracker_peers", "Peers in all swarms", lambda: sum(len(swarm) for swarm in peers.values()))
+metrics.gauge("tracker_seeders", "Seeders in all swarms", lambda: sum(swarm.complete for swarm in peers.values()))
+metrics.gauge("tracker_torrents", "Torrents in the catalog", lambda: len(catalog))
+metrics.gauge("tracker_torrent_cache_bytes", "Bytes of .torrent files held in memory", lambda: torrent_cache.size)
+metrics.gauge("tracker_log_records_dropped", "Log records dropped because the log queue was full",
+              lambda: log_handler.dropped)
+cluster_redirects_total = metrics.counter("tracker_cluster_redirects_total",
+                                          "Requests redirected to the cluster node that owns the info_hash")
+cluster_forwards_total = metrics.counter("tracker_cluster_forwards_total",
+                                         "Scrape and batch announce sub-requests forwarded to other nodes")
+replication_errors_total = metrics.counter("tracker_cluster_replication_errors_total",
+                                           "Failed pushes of swarm changes or torrents to other nodes")
+metrics.gauge("tracker_cluster_nodes_alive", "Cluster nodes currently considered alive",
+              lambda: sum(cluster.alive) if cluster else 1)
+metrics.gauge("tracker_peer_subscribers", "Long-poll requests waiting on /peers/subscribe", lambda: watcher.waiting)
+
 # Exception response
 class BadRequestError(HTTPException):
     def __init__(self, detail: str = "Bad Request Error."):
         super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
 
-def get_peers(peers, info_hash: str):
-    peer_info_dict = peers.get(info_hash, [])
-    if not peer_info_dict:
-        logger.error(f"get_peers in tracker return 0 peer")
-    peer_list: list[Dict[str, Any]] = []
-    for peer in peer_info_dict:
-        peer_list.append({
-            "ip": peer["ip"],
-            "port": peer["port"],
-        })
-    return peer_list
+class ForbiddenError(HTTPException):
+    def __init__(self, detail: str = "Forbidden."):
+        super().__init__(status_code=status.HTTP_403_FORBIDDEN, detail=detail)
+
+def touch_peer(info_hash: str, peer_key: PeerKey):
+    """Cập nhật last_seen của peer và đưa nó về cuối hàng đợi hết hạn."""
+    key = (info_hash, peer_key)
+    last_seen[key] = time.monotonic()
+    last_seen.move_to_end(key)
+
+def replicate_change(info_hash: str, peer_key: PeerKey, seed: Optional[bool]):
+    """
+    Trong cluster, đưa thay đổi của swarm thuộc vùng của node này vào lô gửi sang replica.
+    Thay đổi của vùng mà node này đang phục vụ thay (node sở hữu down) được giữ lại để trả về node đó.
+    """
+    if cluster is None:
+        return
+    owner = cluster.owner(info_hash)
+    if owner == cluster.index:
+        replication_changes[(info_hash, peer_key)] = seed
+    elif not cluster.alive[owner] and cluster.route(info_hash) == cluster.index:
+        failover_changes.setdefault(owner, {})[(info_hash, peer_key)] = seed
+
+def record_change(info_hash: str, peer_key: PeerKey, seed: Optional[bool]):
+    peer_changes[(info_hash, peer_key)] = seed
+    replicate_change(info_hash, peer_key, seed)
+
+def add_peer(info_hash: str, peer_key: PeerKey, is_seed: bool = True, record: bool = True) -> bool:
+    """
+    Thêm peer vào swarm, hoặc làm mới last_seen và trạng thái seeder nếu đã có.
+    record=False khi áp dụng thay đổi đã có trong storage (nạp lúc khởi động, sync từ worker khác).
+    Trả về True nếu peer mới.
+    """
+    touch_peer(info_hash, peer_key)
+    swarm = peers.get(info_hash)
+    if swarm is None:
+        swarm = peers[info_hash] = Swarm()
+    if peer_key in swarm:  # Tránh trùng lặp
+        if swarm.set_seed(peer_key, is_seed) and record:
+            record_change(info_hash, peer_key, is_seed)
+        return False
+    swarm.add(peer_key, is_seed, locality.buckets(peer_key[0]))
+    watcher.publish(info_hash, peer_key, True)
+    if record:
+        record_change(info_hash, peer_key, is_seed)
+    return True
+
+def remove_peer(info_hash: str, peer_key: PeerKey, record: bool = True) -> bool:
+    """Xoá peer khỏi swarm. Trả về True nếu peer có trong swarm."""
+    last_seen.pop((info_hash, peer_key), None)
+    swarm = peers.get(info_hash)
+    if not swarm or peer_key not in swarm:
+        return False
+    swarm.remove(peer_key)
+    watcher.publish(info_hash, peer_key, False)
+    if not swarm:
+        del peers[info_hash]
+        response_cache.pop(info_hash, None)
+    if record:
+        record_change(info_hash, peer_key, None)
+    return True
+
+def sweep_expired_peers() -> int:
+    """Loại các peer không announce lại trong PEER_TTL giây. Trả về số peer đã loại."""
+    cutoff = time.monotonic() - PEER_TTL
+    expired = 0
+    while last_seen:
+        key, seen = next(iter(last_seen.items()))
+        if seen > cutoff:
+            break
+        info_hash, peer_key = key
+        remove_peer(info_hash, peer_key)
+        expired += 1
+    if expired:
+        logger.info(f"Evicted {expired} expired peers")
+    return expired
+
+def announce(info_hash: str, peer_key: PeerKey, event: Optional[str], numwant: int,
+             left: Optional[int] = None) -> List[PeerKey]:
+    """Xử lý một announce (UDP, batch) như announce_peers và trả về danh sách peer_key."""
+    return announce_peers(info_hash, peer_key, event, numwant, left).keys()
+
+def announce_peers(info_hash: str, peer_key: PeerKey, event: Optional[str], numwant: int,
+                   left: Optional[int] = None) -> PeerSelection:
+    """
+    Xử lý một announce: cập nhật swarm theo event rồi trả về tối đa numwant peer của swarm
+    (đã mã hoá sẵn, xem select_peers), không gồm chính peer đang announce.
+    numwant âm (mặc định của BEP 15) được hiểu là DEFAULT_NUMWANT.
+    left là số byte peer còn thiếu; client cũ không gửi left được coi là seeder.
+    Announce định kỳ tới sớm hơn MIN_ANNOUNCE_INTERVAL mà không đổi trạng thái seeder
+    không cập nhật registry, chỉ nhận danh sách peer.
+    """
+    peer_ip, port = peer_key
+    is_seed = not left
+    # Nhãn chỉ lấy trong một tập cố định: event lạ do client gửi không được tạo thêm chuỗi metric
+    announces_total.inc(event if event in ANNOUNCE_EVENTS else "other" if event else "none")
+    swarm = peers.get(info_hash)
+    seen = last_seen.get((info_hash, peer_key))
+    now = time.monotonic()
+    if (event is None and seen is not None and now - seen < MIN_ANNOUNCE_INTERVAL
+            and (left is None or swarm.is_seed(peer_key) == is_seed)):
+        throttled_announces_total.inc()
+        return select_peers(info_hash, swarm, peer_key, numwant, now)
+    if event == "started":
+        if add_peer(info_hash, peer_key, is_seed):
+            logger.info("Added %s %s:%s for info_hash %s", "seeder" if is_seed else "leecher",
+                        peer_ip, port, info_hash, extra={"event": "announce"})
+    elif event == "completed":
+        add_peer(info_hash, peer_key, is_seed=True)
+        downloads[info_hash] = downloads.get(info_hash, 0) + 1
+        logger.info("Peer %s:%s completed info_hash %s", peer_ip, port, info_hash, extra={"event": "announce"})
+    elif event == "stopped":
+        if remove_peer(info_hash, peer_key):
+            logger.info("Removed peer %s:%s for info_hash %s", peer_ip, port, info_hash,
+                        extra={"event": "announce"})
+    elif peer_key in peers.get(info_hash, ()):
+        # Announce định kỳ: chỉ làm mới last_seen (và trạng thái seeder nếu có left) của peer đã đăng ký
+        if left is None:
+            touch_peer(info_hash, peer_key)
+        else:
+            add_peer(info_hash, peer_key, is_seed)
+        # Worker khác và replica cũng phải thấy lần announce này, nếu không chúng sẽ coi peer đã hết hạn
+        if WORKERS > 1:
+            peer_changes[(info_hash, peer_key)] = peers[info_hash].is_seed(peer_key)
+        replicate_change(info_hash, peer_key, peers[info_hash].is_seed(peer_key))
+
+    return select_peers(info_hash, peers.get(info_hash), peer_key, numwant, now)
+
+def select_peers(info_hash: str, swarm: Optional[Swarm], peer_key: PeerKey, numwant: int,
+                 now: float) -> PeerSelection:
+    """
+    Chọn tối đa numwant peer (không gồm peer_key) từ một danh sách đã mã hoá sẵn trong response_cache:
+        swarm nhỏ (cả swarm vừa trong numwant): danh sách là cả swarm, dùng chung cho mọi người
+            hỏi cho tới khi swarm.version đổi (có peer vào/rời swarm)
+        swarm lớn: danh sách là một mẫu ưu tiên peer cùng /24, /16 hoặc site với người hỏi
+            (trừ LOCALITY_RANDOM_FRACTION số peer chọn ngẫu nhiên), dùng chung trong
+            RESPONSE_CACHE_TTL giây cho người hỏi cùng nhóm mạng gần nhất
+    Mẫu được chọn dư một peer để vẫn đủ numwant sau khi bỏ người hỏi.
+    """
+    if numwant < 0:
+        numwant = DEFAULT_NUMWANT
+    count = min(numwant, MAX_NUMWANT)
+    if swarm is None or count <= 0:
+        return NO_PEERS
+    entries = response_cache.get(info_hash)
+    if entries is None:
+        entries = response_cache[info_hash] = {}
+    if len(swarm) <= count + 1:
+        near, key, version = (), None, swarm.version
+    else:
+        near = locality.buckets(peer_key[0]) if LOCALITY_RANDOM_FRACTION < 1 else ()
+        key, version = (near[0] if near else ("random",)), None
+    entry = entries.get(key)
+    if entry is not None and (entry[0] == version if version is not None else entry[1] > now and entry[2] >= count):
+        response_cache_hits_total.inc()
+        packed = entry[3]
+    else:
+        response_cache_misses_total.inc()
+        if version is not None:
+            packed = PackedPeers(swarm)
+            entries[key] = (version, math.inf, count, packed)
+        else:
+            packed = PackedPeers(swarm.sample(count + 1, None, near, LOCALITY_RANDOM_FRACTION))
+            entries[key] = (None, now + RESPONSE_CACHE_TTL, count, packed)
+    return packed.select(count, peer_key)
+
+def sweep_response_cache() -> int:
+    """Bỏ các mẫu peer đã hết hạn khỏi response_cache. Trả về số mục đã bỏ."""
+    now = time.monotonic()
+    removed = 0
+    for info_hash, entries in list(response_cache.items()):
+        for key in [key for key, entry in entries.items() if entry[1] <= now]:
+            del entries[key]
+            removed += 1
+        if not entries:
+            del response_cache[info_hash]
+    return removed
+
+def swarm_stats(info_hash: str) -> Tuple[int, int, int]:
+    """Trả về (complete, incomplete, downloaded) của swarm, O(1) nhờ các bộ đếm được cập nhật mỗi announce."""
+    swarm = peers.get(info_hash)
+    downloaded = downloads.get(info_hash, 0)
+    if swarm is None:
+        return 0, 0, downloaded
+    return swarm.complete, swarm.incomplete, downloaded
+
+def load_peers(peer_dict: Dict[str, List[Dict[str, Any]]]):
+    """Nạp các peer đã lưu trong storage vào registry peers."""
+    peers.clear()
+    last_seen.clear()
+    for info_hash, peer_list in peer_dict.items():
+        for peer in peer_list:
+            # Peer trong snapshot được tính như vừa announce để có đủ một PEER_TTL announce lại
+            add_peer(info_hash, (peer["ip"], peer["port"]), peer.get("seed", True), record=False)
+    logger.info(f"Loaded {sum(len(keys) for keys in peers.values())} peers in {len(peers)} swarms")
+
+def snapshot_peers() -> Dict[str, List[Dict[str, Any]]]:
+    """Chụp registry peers thành dict có thể ghi JSON (định dạng PEER_FILE cũ, thêm cờ "seed")."""
+    return {info_hash: [{"ip": ip, "port": port, "seed": swarm.is_seed((ip, port))} for ip, port in swarm]
+            for info_hash, swarm in peers.items()}
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def write_bytes_atomic(path: str, data: bytes):
+    """Ghi file qua file tạm rồi os.replace để không bao giờ để lại file .torrent ghi dở."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+async def read_upload(file: UploadFile, limit: int) -> bytes:
+    """Đọc file upload theo từng khối, dừng ngay khi vượt quá `limit` byte."""
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"Torrent file is larger than {limit} bytes.")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def compute_info_hash(data: bytes) -> str:
+    """Giải mã nội dung .torrent và trả về SHA-1 (hex) của dictionary 'info' đã bencode."""
+    try:
+        decoded = bencodepy.decode(data)
+    except bencodepy.DecodingError as e:
+        raise BadRequestError(f"Invalid torrent file: {e}") from e
+    if not isinstance(decoded, dict) or not isinstance(decoded.get(b"info"), dict):
+        raise BadRequestError("Torrent file does not contain an 'info' dictionary.")
+    # Encode lại giống TorrentFile ở phía peer để hai bên tính ra cùng một info_hash
+    return hashlib.sha1(bencodepy.encode(decoded[b"info"])).hexdigest()
+
+async def store_torrent(info_hash: str, data: bytes, name: str, description: Optional[str],
+                        broadcast: bool = True) -> bool:
+    """
+    Lưu file .torrent (đã kiểm tra info_hash) vào TORRENT_DIR, danh mục và storage.
+    Torrent đã có trong danh mục (và file còn trên đĩa) được giữ nguyên. Trả về True nếu đã lưu.
+    broadcast=True: trong cluster, torrent còn được gửi tới mọi node khác.
+    """
+    entry = catalog.get(info_hash)
+    if entry is not None and os.path.exists(entry["file_path"]):
+        return False
+    # Lưu theo info_hash: announce lại cùng torrent không tạo thêm file mới
+    file_path = os.path.join(TORRENT_DIR, f"{info_hash}.torrent")
+    if not os.path.exists(file_path):
+        await asyncio.to_thread(write_bytes_atomic, file_path, data)
+    catalog.put(info_hash, file_path, name, description)
+    torrent_cache.invalidate(info_hash)
+    async with torrents_lock:
+        await asyncio.to_thread(storage.save_torrents,
+                                {info_hash: catalog.get(info_hash)},
+                                None if storage.incremental else catalog.to_dict())
+    if cluster is not None and broadcast:
+        # Danh mục torrent không chia vùng: mọi node đều giữ đủ để /torrents trả lời ở bất kỳ node nào
+        for node in range(len(cluster)):
+            if node != cluster.index:
+                pending_torrents.setdefault(node, set()).add(info_hash)
+    return True
+
+async def flush_peers():
+    """Ghi các thay đổi của registry (hoặc snapshot, với storage không incremental) xuống storage."""
+    global peer_changes
+    async with flush_lock:
+        if not peer_changes:
+            return
+        changes = peer_changes
+        peer_changes = {}
+        snapshot = None if storage.incremental else snapshot_peers()
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(storage.save_peers, changes, snapshot)
+        except Exception as e:
+            # Giữ lại lô chưa ghi được; thay đổi mới hơn của cùng peer được ưu tiên
+            changes.update(peer_changes)
+            peer_changes = changes
+            flush_errors_total.inc()
+            logger.error(f"Error writing peers to storage: {str(e)}")
+        finally:
+            flush_duration.observe(time.perf_counter() - started)
+
+async def flush_peers_periodically():
+    interval = FLUSH_INTERVAL if WORKERS == 1 else SYNC_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        await flush_peers()
+
+def apply_remote_changes(remote_peers: List[Tuple[str, PeerKey, Optional[bool]]],
+                         remote_torrents: Dict[str, Dict[str, Any]]):
+    """Áp dụng thay đổi do worker khác ghi vào storage lên registry và danh mục của worker này."""
+    for info_hash, peer_key, seed in remote_peers:
+        # Thay đổi cục bộ chưa flush sẽ được commit sau, nên nó thắng thay đổi từ xa
+        if (info_hash, peer_key) in peer_changes:
+            continue
+        if seed is None:
+            remove_peer(info_hash, peer_key, record=False)
+        else:
+            add_peer(info_hash, peer_key, seed, record=False)
+    for info_hash, entry in remote_torrents.items():
+        catalog.put(info_hash, entry["file_path"], entry["name"], entry["description"])
+        torrent_cache.invalidate(info_hash)
+
+async def sync_peers_periodically():
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL)
+        try:
+            remote_peers, remote_torrents = await asyncio.to_thread(storage.sync)
+        except Exception as e:
+            logger.error(f"Error reading changes of other workers: {str(e)}")
+            continue
+        apply_remote_changes(remote_peers, remote_torrents)
+
+def post_json(url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """POST JSON tới một node khác của cluster (blocking, gọi qua asyncio.to_thread)."""
+    response = requests.post(url, json=payload, headers={CLUSTER_SECRET_HEADER: CLUSTER_SECRET},
+                             timeout=CLUSTER_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def get_json(url: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    response = requests.get(url, params=params, timeout=CLUSTER_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def ping_node(url: str) -> bool:
+    try:
+        return requests.get(url + "/", timeout=CLUSTER_TIMEOUT).ok
+    except requests.RequestException:
+        return False
+
+async def replicate_peers():
+    """
+    Gửi các thay đổi swarm thuộc vùng của node này sang replica (node kế tiếp).
+    Khi replica chưa đồng bộ (lần gửi đầu, vừa lỗi hoặc vừa lên lại) thì gửi toàn bộ vùng
+    thay vì chỉ các thay đổi, nên thay đổi bị bỏ khi replica down không làm nó lệch mãi.
+    """
+    global replication_changes, replica_synced
+    replica = cluster.successor
+    if replica == cluster.index:
+        replication_changes = {}
+        return
+    if not cluster.alive[replica]:
+        replication_changes = {}
+        replica_synced = False
+        return
+    full = not replica_synced
+    if full:
+        changes = {(info_hash, peer_key): swarm.is_seed(peer_key)
+                   for info_hash, swarm in peers.items() if cluster.owns(info_hash)
+                   for peer_key in swarm}
+    else:
+        changes = replication_changes
+    replication_changes = {}
+    if not changes and not full:
+        return
+    payload = {"node": cluster.index, "full": full,
+               "peers": [[info_hash, ip, port, seed] for (info_hash, (ip, port)), seed in changes.items()]}
+    try:
+        await asyncio.to_thread(post_json, cluster.nodes[replica] + "/cluster/replicate", payload)
+        replica_synced = True
+    except requests.RequestException as e:
+        replica_synced = False
+        replication_errors_total.inc()
+        logger.warning(f"Error replicating {len(changes)} peer changes to {cluster.nodes[replica]}: {str(e)}")
+
+async def return_failover_changes():
+    """
+    Trả các thay đổi node này nhận thay khi node sở hữu down về node đó khi nó lên lại,
+    để lần đồng bộ toàn vùng từ node sở hữu sau đó không làm mất các peer đã đăng ký trong lúc failover.
+    """
+    for node, changes in list(failover_changes.items()):
+        if not changes or not cluster.alive[node]:
+            continue
+        payload = {"node": cluster.index, "full": False,
+                   "peers": [[info_hash, ip, port, seed] for (info_hash, (ip, port)), seed in changes.items()]}
+        try:
+            await asyncio.to_thread(post_json, cluster.nodes[node] + "/cluster/replicate", payload)
+        except requests.RequestException as e:
+            replication_errors_total.inc()
+            logger.warning(f"Error returning {len(changes)} failover peer changes to {cluster.nodes[node]}: {str(e)}")
+            continue
+        # Thay đổi mới tới trong lúc gửi được giữ cho lần sau
+        remaining = failover_changes[node]
+        for key, seed in changes.items():
+            if remaining.get(key, seed) is seed:
+                remaining.pop(key, None)
+        if not remaining:
+            del failover_changes[node]
+
+async def broadcast_torrents():
+    """Gửi các torrent mới upload tới mọi node khác để danh mục của cả cluster giống nhau."""
+    for node, pending in list(pending_torrents.items()):
+        if not pending or not cluster.alive[node]:
+            continue
+        torrents = []
+        for info_hash in list(pending)[:MAX_TORRENT_BROADCAST]:
+            entry = catalog.get(info_hash)
+            data = torrent_cache.get(info_hash) or await asyncio.to_thread(read_file, entry["file_path"])
+            torrents.append({"info_hash": info_hash, "name": entry["name"], "description": entry["description"],
+                             "data": base64.b64encode(data).decode("ascii")})
+        try:
+            await asyncio.to_thread(post_json, cluster.nodes[node] + "/cluster/torrents", {"torrents": torrents})
+            pending.difference_update(torrent["info_hash"] for torrent in torrents)
+        except requests.RequestException as e:
+            replication_errors_total.inc()
+            logger.warning(f"Error sending {len(torrents)} torrents to {cluster.nodes[node]}: {str(e)}")
+
+async def replicate_periodically():
+    while True:
+        await asyncio.sleep(REPLICATION_INTERVAL)
+        await return_failover_changes()
+        await replicate_peers()
+        await broadcast_torrents()
+
+async def check_nodes_periodically():
+    """Health check các node khác; node down được thay bằng replica của nó khi định tuyến."""
+    global replica_synced
+    others = [node for node in range(len(cluster)) if node != cluster.index]
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        results = await asyncio.gather(*(asyncio.to_thread(ping_node, cluster.nodes[node]) for node in others))
+        for node, alive in zip(others, results):
+            if cluster.set_alive(node, alive):
+                logger.warning(f"Cluster node {cluster.nodes[node]} is {'up' if alive else 'down'}")
+                if alive and node == cluster.successor:
+                    # Replica có thể vừa khởi động lại với trạng thái cũ
+                    replica_synced = False
+
+def apply_replicated_peers(node: int, full: bool, changes: List[Tuple[str, str, int, Optional[bool]]]):
+    """
+    Áp dụng các thay đổi swarm node `node` gửi sang: node này là replica của nó,
+    hoặc là node sở hữu nhận lại các thay đổi replica đã nhận thay trong lúc node này down.
+    full=True: changes là toàn bộ vùng của node đó, peer của vùng không có trong changes bị xoá,
+    trừ các peer node này còn phải trả lại cho node đó (xem return_failover_changes).
+    Thay đổi được ghi xuống storage như announce thường; replica không gửi tiếp chúng sang replica khác,
+    node sở hữu gửi các thay đổi trả lại sang replica của nó như announce thường.
+    """
+    if full:
+        incoming = {(info_hash, (ip, port)) for info_hash, ip, port, _ in changes}
+        pending = failover_changes.get(node, {})
+        for info_hash in [info_hash for info_hash in peers if cluster.owner(info_hash) == node]:
+            for peer_key in list(peers[info_hash]):
+                if (info_hash, peer_key) not in incoming and (info_hash, peer_key) not in pending:
+                    remove_peer(info_hash, peer_key)
+    for info_hash, ip, port, seed in changes:
+        peer_key = (ip, port)
+        if seed is None:
+            remove_peer(info_hash, peer_key)
+        else:
+            add_peer(info_hash, peer_key, seed)
+            if WORKERS > 1:
+                peer_changes[(info_hash, peer_key)] = seed
+
+async def sweep_peers_periodically():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        sweep_expired_peers()
+        sweep_response_cache()
+        watcher.sweep()
+
+def open_storage(backend: str) -> Storage:
+    if backend == "sqlite":
+        # Mỗi worker có id riêng để không đọc lại thay đổi của chính mình từ log
+        return SQLiteStorage(DB_FILE, worker_id=f"{os.getpid()}-{uuid.uuid4().hex[:8]}" if WORKERS > 1 else None)
+    if WORKERS > 1:
+        raise RuntimeError("Running several workers requires the sqlite storage backend.")
+    return JsonStorage(TORRENT_FILE, PEER_FILE)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global storage
+    storage = open_storage(STORAGE_BACKEND)
+    load_peers(await asyncio.to_thread(storage.load_peers))
+    catalog.load(await asyncio.to_thread(storage.load_torrents))
+    logger.info(f"Loaded {len(catalog)} torrents from {STORAGE_BACKEND} storage")
+    background_tasks = [asyncio.create_task(flush_peers_periodically()),
+                        asyncio.create_task(sweep_peers_periodically())]
+    if WORKERS > 1:
+        background_tasks.append(asyncio.create_task(sync_peers_periodically()))
+    if cluster is not None:
+        background_tasks.append(asyncio.create_task(replicate_periodically()))
+        background_tasks.append(asyncio.create_task(check_nodes_periodically()))
+        logger.info(f"Cluster node {cluster.index} of {len(cluster)}, owning info_hash range "
+                    f"{'-'.join(cluster.key_range(cluster.index))}")
+    udp_transport = None
+    if UDP_ADDRESS:
+        # Các worker dùng chung secret (do main() sinh) để connection id cấp bởi worker này
+        # vẫn hợp lệ khi gói tiếp theo của client được kernel chuyển tới worker khác
+        secret = os.environ.get("TRACKER_UDP_SECRET")
+        udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: UDPTrackerProtocol(announce=announce, scrape=swarm_stats, interval=ANNOUNCE_INTERVAL,
+                                       secret=bytes.fromhex(secret) if secret else None),
+            local_addr=UDP_ADDRESS,
+            reuse_port=WORKERS > 1)
+        logger.info(f"UDP tracker listening on {UDP_ADDRESS[0]}:{UDP_ADDRESS[1]}")
+    try:
+        yield
+    finally:
+        if udp_transport:
+            udp_transport.close()
+        for task in background_tasks:
+            task.cancel()
+        for task in background_tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        await flush_peers()
+        storage.close()
+
+class BodyLimitMiddleware:
+    """
+    ASGI middleware giới hạn body của các route upload trước khi FastAPI parse form
+    (Starlette đọc hết multipart vào bộ nhớ/file tạm trước khi handler chạy):
+        Content-Length vượt giới hạn: trả 413 ngay, không đọc body
+        không có Content-Length (chunked): dừng với 413 khi số byte đã nhận vượt giới hạn
+    """
+
+    def __init__(self, app, limits: Dict[Tuple[str, str], int]):
+        self.app = app
+        self.limits = limits # {(method, path): số byte tối đa}
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        detail = f"Request body is larger than {limit} bytes."
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            response = JSONResponse({"detail": detail}, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            await response(scope, receive, send)
+            return
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(BodyLimitMiddleware, limits={("POST", "/announce"): MAX_UPLOAD_BODY})
+app.add_middleware(MetricsMiddleware, requests=http_requests_total, latency=http_request_duration)
 
 @app.get("/")
 def get_status():
     return {"status": "Tracker is running."}
 
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def is_forwarded(request: Request) -> bool:
+    """Request đã được một node khác chuyển tới: luôn xử lý tại chỗ để không chuyển vòng giữa các node."""
+    return request.query_params.get("cluster_hop") == "1"
+
+def cluster_redirect(request: Request, info_hash: str) -> Optional[RedirectResponse]:
+    """Trong cluster, chuyển request của info_hash do node khác phục vụ tới node đó (307 giữ nguyên method)."""
+    if cluster is None or is_forwarded(request):
+        return None
+    node = cluster.route(info_hash)
+    if node == cluster.index:
+        return None
+    cluster_redirects_total.inc()
+    return RedirectResponse(url=f"{cluster.nodes[node]}{request.url.path}?{request.url.query}&cluster_hop=1",
+                            status_code=status.HTTP_307_TEMPORARY_REDIRECT)
+
+def group_by_node(request: Request, info_hashes: List[str]) -> Dict[int, List[str]]:
+    """Chia các info_hash theo node phục vụ chúng; ngoài cluster mọi info_hash đều thuộc node này (0)."""
+    if cluster is None or is_forwarded(request):
+        return {cluster.index if cluster else 0: list(info_hashes)}
+    groups: Dict[int, List[str]] = {}
+    for info_hash in info_hashes:
+        groups.setdefault(cluster.route(info_hash), []).append(info_hash)
+    return groups
+
 @app.get("/announce")
 async def announce_get(request: Request,
                        info_hash: str = Query(...),
                        port: int = Query(...),
                        ip: str = Query(None),
-                       event: str = Query(None),):
-    public_ip = request.client.host
-    peer = {"ip": ip or public_ip, "port": port}
-    with open(PEER_FILE, "r") as f:
-        peer_dict = json.load(f)
-
-    if info_hash not in peer_dict:
-        peer_dict[info_hash] = []
-    # def add_peer(peer: Dict[str, Any]):
-    #     if event == "started":
-    #         if peer not in peer_dict[info_hash]:
-    #             peer_dict[info_hash].append(peer)
-    #             logger.info(f"Added peer {ip}:{port} for info_hash {info_hash}")
-    #     elif event == "stopped":
-    #         if peer in peer_dict[info_hash]:
-    #             peer_dict[info_hash].remove(peer)
-    # if ip != public_ip:
-    #     add_peer({"ip": ip, "port": port})
-    # add_peer({"ip": public_ip, "port": port})
-    if event == "started":
-        if peer not in peer_dict[info_hash]:  # Tránh trùng lặp
-            peer_dict[info_hash].append(peer)
-            logger.info(f"Added peer {peer['ip']}:{peer['port']} for info_hash {info_hash}")
-    elif event == "stopped":
-        if peer in peer_dict[info_hash]:
-            peer_dict[info_hash].remove(peer)
-            logger.info(f"Removed peer {peer['ip']}:{peer['port']} for info_hash {info_hash}")
+                       event: str = Query(None),
+                       compact: int = Query(0),
+                       numwant: int = Query(DEFAULT_NUMWANT),
+                       left: int = Query(None),):
+    # info_hash hex được nhận cả chữ hoa lẫn chữ thường, như mọi endpoint khác
+    info_hash = info_hash.lower()
+    redirect = cluster_redirect(request, info_hash)
+    if redirect:
+        return redirect
+    peer_key = (ip or request.client.host, port)
+    selection = announce_peers(info_hash, peer_key, event, numwant, left)
+    # Danh sách peer đã được mã hoá sẵn nên phản hồi chỉ là ghép bytes, không qua bencode/JSON encoder
+    if compact:
+        peers4, peers6 = selection.compact()
+        body = b"d8:intervali%de12:min intervali%de5:peers%d:%s" % (
+            ANNOUNCE_INTERVAL, MIN_ANNOUNCE_INTERVAL, len(peers4), peers4)
+        if peers6:
+            body += b"6:peers6%d:%s" % (len(peers6), peers6)
+        logger.debug("Compact response for info_hash %s: %d IPv4 + %d IPv6 peers",
+                     info_hash, len(peers4) // 6, len(peers6) // 18)
+        return Response(content=body + b"e", media_type="text/plain")
+    body = b'{"peers":%s,"interval":%d,"min_interval":%d}' % (
+        selection.json(), ANNOUNCE_INTERVAL, MIN_ANNOUNCE_INTERVAL)
+    logger.debug("Response for info_hash %s: %s", info_hash, body)
+    return Response(content=body, media_type="application/json")
 
-    peer_list = get_peers(peer_dict, info_hash)
-    try:
-        with open(PEER_FILE, "w") as f:
-            json.dump(peer_dict, f, indent=4)
-    except Exception as e:
-        logger.error(f"Error writing to PEER_FILE: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error saving peer data")
-    reply = {"peers": peer_list, "interval": ANNOUNCE_INTERVAL}
-    logger.info(f"Response for info_hash {info_hash}: {reply}")
-    return reply
 
+class BatchAnnounceItem(BaseModel):
+    info_hash: str
+    event: Optional[str] = None
+    left: Optional[int] = None
+
+class BatchAnnounce(BaseModel):
+    port: int
+    ip: Optional[str] = None
+    numwant: int = 0 # Mặc định không trả peer: seeder announce hàng loạt thường không cần
+    announces: List[BatchAnnounceItem]
+
+@app.post("/announce/batch")
+async def announce_batch(request: Request, batch: BatchAnnounce):
+    """
+    Announce nhiều torrent của cùng một peer trong một request, ví dụ khi peer khởi động,
+    tắt hoặc announce lại định kỳ mọi torrent đang seed:
+        {"port": 6881, "ip": "...", "numwant": 0,
+         "announces": [{"info_hash": "<hex>", "event": "started", "left": 0}, ...]}
+    Với SQLite, mọi thay đổi của lô được ghi xuống storage ngay trong một lần flush (một transaction);
+    với storage JSON (ghi cả snapshot) chúng chờ lần flush định kỳ như announce thường.
+    Trả về {"interval", "min_interval", "peers": {info_hash: [{"ip", "port"}]}} (peers chỉ có khi numwant > 0).
+    """
+    if len(batch.announces) > MAX_BATCH_ANNOUNCES:
+        raise BadRequestError(f"At most {MAX_BATCH_ANNOUNCES} announces are allowed per batch.")
+    peer_key = (batch.ip or request.client.host, batch.port)
+    for item in batch.announces:
+        item.info_hash = item.info_hash.lower()
+    items = {item.info_hash: item for item in batch.announces}
+    groups = group_by_node(request, list(items))
+    local = cluster.index if cluster else 0
+    results = {}
+    # Trong cluster, phần của các node khác được chuyển tiếp nguyên lô (kèm IP thật của peer)
+    remote_nodes = [node for node in groups if node != local]
+    replies = await asyncio.gather(*(
+        asyncio.to_thread(post_json, f"{cluster.nodes[node]}/announce/batch?cluster_hop=1",
+                          {"port": batch.port, "ip": peer_key[0], "numwant": batch.numwant,
+                           "announces": [items[info_hash].model_dump() for info_hash in groups[node]]})
+        for node in remote_nodes), return_exceptions=True)
+    for node, reply in zip(remote_nodes, replies):
+        cluster_forwards_total.inc()
+        if isinstance(reply, Exception):
+            # Node không trả lời được thì xử lý tại chỗ, peer sẽ về đúng node ở lần announce sau
+            logger.warning(f"Error forwarding batch announce to {cluster.nodes[node]}: {str(reply)}")
+            groups.setdefault(local, []).extend(groups[node])
+        else:
+            results.update(reply.get("peers", {}))
+    for info_hash in groups.get(local, ()):
+        item = items[info_hash]
+        peer_keys = announce(item.info_hash, peer_key, item.event, batch.numwant, item.left)
+        if batch.numwant:
+            results[item.info_hash] = [{"ip": ip, "port": port} for ip, port in peer_keys]
+    if storage.incremental:
+        await flush_peers()
+    return {"interval": ANNOUNCE_INTERVAL, "min_interval": MIN_ANNOUNCE_INTERVAL, "peers": results}
+
+@app.get("/scrape")
+async def scrape(request: Request, info_hash: List[str] = Query(...)):
+    """
+    Trả về số seeder (complete), leecher (incomplete) và số lượt tải xong (downloaded)
+    cho nhiều info_hash trong một request, ví dụ: /scrape?info_hash=<a>&info_hash=<b>
+    Trong cluster, info_hash của node khác được hỏi lại node đó.
+    Kết quả được trả theo info_hash viết thường.
+    """
+    groups = group_by_node(request, [hash_value.lower() for hash_value in info_hash])
+    local = cluster.index if cluster else 0
+    files = {}
+    remote_nodes = [node for node in groups if node != local]
+    replies = await asyncio.gather(*(
+        asyncio.to_thread(get_json, f"{cluster.nodes[node]}/scrape",
+                          {"info_hash": groups[node], "cluster_hop": 1})
+        for node in remote_nodes), return_exceptions=True)
+    for node, reply in zip(remote_nodes, replies):
+        cluster_forwards_total.inc()
+        if isinstance(reply, Exception):
+            # Trả số liệu của node này (replica có thể có) thay vì lỗi cả request
+            logger.warning(f"Error forwarding scrape to {cluster.nodes[node]}: {str(reply)}")
+            groups.setdefault(local, []).extend(groups[node])
+        else:
+            files.update(reply.get("files", {}))
+    for hash_value in groups.get(local, ()):
+        complete, incomplete, downloaded = swarm_stats(hash_value)
+        files[hash_value] = {"complete": complete, "incomplete": incomplete, "downloaded": downloaded}
+    return {"files": files}
+
+@app.get("/peers/subscribe")
+async def subscribe_peers(request: Request,
+                          info_hash: str = Query(...),
+                          cursor: str = Query(None),
+                          timeout: float = Query(SUBSCRIBE_TIMEOUT)):
+    """
+    Long-poll các peer vào/rời swarm của info_hash, để leecher kết nối ngay tới peer mới
+    thay vì chờ tới lần announce tiếp theo.
+    Request đầu tiên (không có cursor) hoặc có cursor không còn dùng được nhận ngay
+    {"cursor", "reset": true, "joined": [tối đa MAX_NUMWANT peer của swarm], "left": []}.
+    Các request sau gửi lại cursor vừa nhận và được trả lời ngay khi swarm có thay đổi,
+    hoặc sau timeout giây với joined/left rỗng: {"cursor", "reset": false, "joined", "left"}.
+    Cursor chỉ có nghĩa với tracker (worker) đã cấp nó; client không cần phân tích.
+    """
+    info_hash = info_hash.lower()
+    redirect = cluster_redirect(request, info_hash)
+    if redirect:
+        return redirect
+    timeout = min(max(timeout, 0), MAX_SUBSCRIBE_TIMEOUT)
+    version, changes = await watcher.wait(info_hash, cursor, timeout)
+    if changes is None:
+        swarm = peers.get(info_hash)
+        joined, left = (swarm.sample(MAX_NUMWANT) if swarm else []), []
+    else:
+        joined, left = changes
+    return {"cursor": watcher.cursor(version), "reset": changes is None,
+            "joined": [{"ip": ip, "port": port} for ip, port in joined],
+            "left": [{"ip": ip, "port": port} for ip, port in left]}
+
+class ReplicatedPeers(BaseModel):
+    node: int
+    full: bool = False
+    peers: List[Tuple[str, str, int, Optional[bool]]]
+
+class ReplicatedTorrent(BaseModel):
+    info_hash: str
+    name: Optional[str] = None
+    description: Optional[str] = None
+    data: str # Nội dung file .torrent, base64
+
+class ReplicatedTorrents(BaseModel):
+    torrents: List[ReplicatedTorrent]
+
+@app.get("/cluster")
+async def get_cluster():
+    """Cấu hình cluster theo góc nhìn của node này: các node, vùng info_hash của từng node và trạng thái."""
+    if cluster is None:
+        return {"node": 0, "nodes": []}
+    return {"node": cluster.index,
+            "nodes": [{"url": url, "alive": cluster.alive[node], "range": cluster.key_range(node)}
+                      for node, url in enumerate(cluster.nodes)]}
+
+def check_cluster_secret(request: Request):
+    """Chỉ nhận request giữa các node mang đúng secret của cluster."""
+    secret = request.headers.get(CLUSTER_SECRET_HEADER, "")
+    if not CLUSTER_SECRET or not hmac.compare_digest(secret.encode(), CLUSTER_SECRET.encode()):
+        raise ForbiddenError("Missing or wrong cluster secret.")
+
+@app.post("/cluster/replicate")
+async def cluster_replicate(batch: ReplicatedPeers, request: Request):
+    """Nhận thay đổi swarm từ node mà node này làm replica, hoặc từ replica trả lại sau failover (xem replicate_peers)."""
+    if cluster is None or not 0 <= batch.node < len(cluster):
+        raise BadRequestError("This tracker is not a member of the sender's cluster.")
+    check_cluster_secret(request)
+    apply_replicated_peers(batch.node, batch.full, batch.peers)
+    return {"applied": len(batch.peers)}
+
+@app.post("/cluster/torrents")
+async def cluster_torrents(batch: ReplicatedTorrents, request: Request):
+    """Nhận các torrent được upload lên node khác của cluster (xem broadcast_torrents)."""
+    if cluster is None:
+        raise BadRequestError("This tracker is not part of a cluster.")
+    check_cluster_secret(request)
+    stored = 0
+    for torrent in batch.torrents:
+        data = base64.b64decode(torrent.data)
+        if compute_info_hash(data) != torrent.info_hash:
+            raise BadRequestError(f"info_hash does not match the torrent file of {torrent.info_hash}.")
+        # Không đưa vào pending_torrents lần nữa: node gửi đã tự gửi tới mọi node
+        stored += await store_torrent(torrent.info_hash, data, torrent.name, torrent.description,
+                                      broadcast=False)
+    return {"stored": stored}
 
 
 def decode_keys(data):
@@ -132,25 +989,21 @@ async def announce_post(port: int = Query(...),
                         comment: str = Form(None)):
     if not file.filename.endswith(".torrent"):
         raise BadRequestError("The processing file is not a .torrent file.")
-    logger.info(f"Received announce for info_hash: {info_hash}")
-    with open(TORRENT_FILE, "r") as f:
-        torrent_dict = json.load(f)
-        # torrent_dict = decode_keys(torrent_dict)
-    logger.info(f"Current torrent_dict: {torrent_dict}")
-    if info_hash not in torrent_dict or not os.path.exists(torrent_dict[info_hash]["file_path"]):
-        file_path = os.path.join(TORRENT_DIR, f"{uuid.uuid4()}.torrent")
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-        name = name + ".torrent" if name else file.filename
-        if info_hash not in torrent_dict:
-            torrent_dict[info_hash] = {}
-            logger.info(f"Initialized new entry for {info_hash} from tracker announce_post")
-        torrent_dict[info_hash]["file_path"] = file_path
-        torrent_dict[info_hash]["name"] = name
-        torrent_dict[info_hash]["description"] = comment
-        with open(TORRENT_FILE, "w") as f:
-            json.dump(torrent_dict, f, indent=4)
-        logger.info(f"Updated torrent_dict: {torrent_dict}")
+    logger.info("Received announce for info_hash: %s", info_hash, extra={"event": "upload"})
+    if logger.isEnabledFor(logging.DEBUG):
+        # Dump cả danh mục tốn O(số torrent) nên chỉ làm khi bật DEBUG
+        logger.debug("Current torrent_dict: %s", catalog.to_dict())
+    info_hash = info_hash.lower()
+    data = await read_upload(file, MAX_TORRENT_SIZE)
+    if compute_info_hash(data) != info_hash:
+        raise BadRequestError("info_hash does not match the uploaded torrent file.")
+    is_new = info_hash not in catalog
+    if await store_torrent(info_hash, data, name + ".torrent" if name else file.filename, comment):
+        if is_new:
+            logger.info("Initialized new entry for %s from tracker announce_post", info_hash,
+                        extra={"event": "upload"})
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Updated torrent_dict: %s", catalog.to_dict())
     return RedirectResponse(
         url=f"/announce?info_hash={info_hash}&port={port}&{'ip=' + ip + '&' if ip else ''}event=started",
         # url=f"/announce/{info_hash}&event=started",
@@ -158,31 +1011,145 @@ async def announce_post(port: int = Query(...),
     )
 
 @app.get("/torrents")
-async def get_torrents():
-    with open(TORRENT_FILE, "r") as f:
-        torrent_dict = json.load(f)
-    #loại bỏ thông tin "file_path" để ẩn thông tin nội bộ
-    for info_hash in torrent_dict:
-        if "file_path" in torrent_dict[info_hash]:
-            del torrent_dict[info_hash]["file_path"]
-    return torrent_dict
+async def get_torrents(request: Request,
+                       limit: int = Query(None, ge=1),
+                       cursor: str = Query(None),
+                       q: str = Query(None)):
+    """
+    Danh mục torrent {info_hash: {"name", "description"}}.
+        limit, cursor: phân trang theo info_hash; cursor của trang tiếp theo nằm trong header X-Next-Cursor
+        q: lọc theo tên chứa chuỗi q (không phân biệt hoa thường)
+    Hỗ trợ ETag / If-None-Match: trả 304 nếu client đã có đúng nội dung.
+    """
+    headers = {}
+    if limit is None and cursor is None and not q:
+        body, etag = catalog.full_body()
+    else:
+        page, next_cursor = catalog.page(min(limit or MAX_CATALOG_PAGE, MAX_CATALOG_PAGE), cursor, q)
+        body = json.dumps(page).encode("utf-8")
+        etag = make_etag(body)
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+    headers["ETag"] = etag
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/torrents/{info_hash}")
-async def get_torrent(info_hash: str):
-    with open(TORRENT_FILE, "r") as f:
-        torrent_dict = json.load(f)
-        if info_hash not in torrent_dict:
-            raise BadRequestError("Info hash does not exist.")
-    return FileResponse(path = torrent_dict[info_hash]["file_path"],
-                        filename = torrent_dict[info_hash]["name"],
-                        media_type = "application/octet-stream")
+async def get_torrent(request: Request, info_hash: str):
+    info_hash = info_hash.lower()
+    entry = catalog.get(info_hash)
+    if entry is None:
+        raise BadRequestError("Info hash does not exist.")
+    # info_hash xác định duy nhất nội dung torrent nên dùng luôn làm strong ETag
+    etag = f'"{info_hash}"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    data = torrent_cache.get(info_hash)
+    if data is None:
+        data = await asyncio.to_thread(read_file, entry["file_path"])
+        torrent_cache.put(info_hash, data)
+    filename = entry["name"] or f"{info_hash}.torrent"
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        content_disposition = f"attachment; filename*=utf-8''{quoted_filename}"
+    else:
+        content_disposition = f'attachment; filename="{filename}"'
+    return Response(content=data,
+                    media_type="application/octet-stream",
+                    headers={"ETag": etag, "Content-Disposition": content_disposition})
 @click.command()
 @click.option("--h", "host", default="127.0.0.1",  help="Running host for tracker")
 @click.option("--p", "port", default=8000, help="Running port for tracker")
-def main(host="127.0.0.1", port = 8000):
-    uvicorn.run(app=app,
+@click.option("--udp-port", "udp_port", default=None, type=int,
+              help="UDP tracker port (default: same as --p, 0 to disable; not available with --cluster)")
+@click.option("--storage", "storage_backend", default="json", type=click.Choice(["json", "sqlite"]),
+              help="Where torrents and peers are persisted (sqlite uses tracker.db in WAL mode)")
+@click.option("--workers", "workers", default=1, type=click.IntRange(min=1),
+              help="Number of worker processes (more than 1 requires --storage sqlite)")
+@click.option("--log-level", "log_level", default=None,
+              type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+              help="Tracker log level (default: INFO)")
+@click.option("--log-sample", "log_sample", default=None,
+              help='Fraction of per-request log lines to keep, e.g. "announce=0.01,upload=1"')
+@click.option("--data-dir", "data_dir", default=None, type=click.Path(file_okay=False),
+              help="Directory for torrents, peers and tracker.db (default: next to Tracker.py)")
+@click.option("--cluster", "cluster_nodes", default=None,
+              help='Comma separated URLs of all cluster nodes, in the same order on every node, '
+                   'e.g. "http://127.0.0.1:8000,http://127.0.0.1:8001"')
+@click.option("--node", "node", default=0, type=click.IntRange(min=0),
+              help="Position of this tracker in --cluster")
+@click.option("--cluster-secret", "cluster_secret", default=None,
+              help="Secret shared by all cluster nodes to authenticate replication requests "
+                   "(default: TRACKER_CLUSTER_SECRET environment variable)")
+@click.option("--site-prefix", "site_prefixes", multiple=True,
+              help='Network prefix of a site, optionally named ("hn=10.1.0.0/16"); repeat for more prefixes. '
+                   'Peers of the same site are preferred after same /24 and /16 peers')
+@click.option("--locality-random", "locality_random", default=None, type=click.FloatRange(0, 1),
+              help="Fraction of each peer list picked at random instead of by proximity (default: 0.25, 1 disables)")
+def main(host="127.0.0.1", port = 8000, udp_port = None, storage_backend = "json", workers = 1,
+         log_level = None, log_sample = None, data_dir = None, cluster_nodes = None, node = 0,
+         cluster_secret = None, site_prefixes = (), locality_random = None):
+    global UDP_ADDRESS, STORAGE_BACKEND, WORKERS, DATA_DIR, TORRENT_DIR, PEER_FILE, TORRENT_FILE, DB_FILE, cluster
+    global locality, LOCALITY_RANDOM_FRACTION, CLUSTER_SECRET
+    if workers > 1 and storage_backend != "sqlite":
+        raise click.BadParameter("several workers can only share state through --storage sqlite",
+                                 param_hint="--workers")
+    STORAGE_BACKEND = storage_backend
+    WORKERS = workers
+    if data_dir:
+        DATA_DIR = os.path.abspath(data_dir)
+        TORRENT_DIR = os.path.join(DATA_DIR, "tracker_torrents")
+        PEER_FILE = os.path.join(DATA_DIR, "tracker_peers.json")
+        TORRENT_FILE = os.path.join(DATA_DIR, "tracker_torrents.json")
+        DB_FILE = os.environ.get("TRACKER_DB", os.path.join(DATA_DIR, "tracker.db"))
+        os.makedirs(TORRENT_DIR, exist_ok=True)
+        os.environ["TRACKER_DATA_DIR"] = DATA_DIR
+    if cluster_nodes:
+        try:
+            cluster = Cluster([url.strip() for url in cluster_nodes.split(",") if url.strip()], node)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--node")
+        # Announce UDP không chuyển hướng được tới node sở hữu info_hash
+        if udp_port:
+            raise click.BadParameter("the UDP tracker cannot be used in cluster mode", param_hint="--udp-port")
+        udp_port = 0
+        CLUSTER_SECRET = cluster_secret or CLUSTER_SECRET
+        if not CLUSTER_SECRET:
+            raise click.BadParameter("cluster mode needs a secret shared by all nodes",
+                                     param_hint="--cluster-secret")
+        os.environ["TRACKER_CLUSTER"] = ",".join(cluster.nodes)
+        os.environ["TRACKER_CLUSTER_SECRET"] = CLUSTER_SECRET
+        os.environ["TRACKER_NODE"] = str(node)
+    if site_prefixes:
+        spec = ",".join(site_prefixes)
+        try:
+            locality = Locality(parse_site_prefixes(spec))
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--site-prefix")
+        os.environ["TRACKER_SITE_PREFIXES"] = spec
+    if locality_random is not None:
+        LOCALITY_RANDOM_FRACTION = locality_random
+        os.environ["TRACKER_LOCALITY_RANDOM"] = str(locality_random)
+    udp_port = port if udp_port is None else udp_port
+    UDP_ADDRESS = (host, udp_port) if udp_port else None
+    # Worker process import lại module Tracker nên chỉ nhận được cấu hình qua biến môi trường
+    os.environ["TRACKER_STORAGE"] = storage_backend
+    os.environ["TRACKER_WORKERS"] = str(workers)
+    os.environ["TRACKER_UDP_ADDRESS"] = f"{host}:{udp_port}" if udp_port else ""
+    os.environ["TRACKER_UDP_SECRET"] = os.urandom(16).hex()
+    if log_level:
+        os.environ["TRACKER_LOG_LEVEL"] = log_level
+        logging.getLogger().setLevel(log_level.upper())
+    if log_sample is not None:
+        os.environ["TRACKER_LOG_SAMPLE"] = log_sample
+        for log_filter in log_handler.filters:
+            log_filter.rates = parse_sample_rates(log_sample)
+    uvicorn.run(app=app if workers == 1 else "Tracker:app",
                 host=host,
                 port=port,
+                workers=workers,
+                app_dir=BASE_DIR,
                 reload=False)
 if __name__ == "__main__":
     main()
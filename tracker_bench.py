@@ -0,0 +1,360 @@
+"""
+Load test / benchmark cho tracker.
+
+    python tracker_bench.py --workers 1,2,4 --duration 10
+    python tracker_bench.py --workers 1 --storage json --mix "announce=60,started=10,stopped=5,catalog=10,torrent=10,upload=5"
+    python tracker_bench.py --nodes 1,2,4 --workers 1
+
+Mỗi lần chạy khởi động một tracker riêng (database và log trong thư mục tạm), upload sẵn
+một torrent hợp lệ cho mỗi swarm, rồi nhiều client process (mỗi process nhiều kết nối
+HTTP/1.1 keep-alive chạy bằng asyncio) gửi request theo tỉ lệ của --mix:
+    started  : GET /announce?event=started cho một peer chưa tham gia swarm
+    announce : GET /announce định kỳ của một peer đã tham gia
+    stopped  : GET /announce?event=stopped, peer rời swarm
+    scrape   : GET /scrape
+    catalog  : GET /torrents?limit=100
+    torrent  : GET /torrents/{info_hash}
+    upload   : POST /announce (upload lại một torrent đã có)
+Với --nodes N > 1, N tracker chạy thành một cluster trên localhost; client gửi mỗi request
+theo info_hash thẳng tới node sở hữu nó (như peer đã nhớ node sau lần redirect đầu tiên).
+Kết quả (số request/giây, độ trễ p50/p99 theo từng loại request) được in ra stdout dạng JSON.
+"""
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+
+import bencodepy
+import click
+
+from tracker_cluster import owner_of
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OPERATIONS = ("started", "announce", "stopped", "scrape", "catalog", "torrent", "upload")
+DEFAULT_MIX = "announce=60,started=10,stopped=5,scrape=5,catalog=5,torrent=10,upload=5"
+BOUNDARY = "tracker-bench-boundary"
+CLUSTER_SECRET = "tracker-bench-cluster" # Secret chung của các node trong cluster benchmark
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Đọc tỉ lệ request dạng "announce=60,catalog=10" (trọng số, không cần cộng lại bằng 100)."""
+    mix = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        operation, _, weight = item.partition("=")
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise click.BadParameter(f"unknown operation {operation!r}, expected one of {', '.join(OPERATIONS)}",
+                                     param_hint="--mix")
+        mix[operation] = float(weight)
+    if not any(mix.values()):
+        raise click.BadParameter("at least one operation needs a positive weight", param_hint="--mix")
+    return mix
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_tracker(port: int, workers: int, work_dir: str, storage: str = "sqlite",
+                  cluster: Optional[List[str]] = None, node: int = 0) -> subprocess.Popen:
+    """
+    Chạy Tracker.py trong process con, dùng dữ liệu và log trong work_dir, rồi chờ tới khi sẵn sàng.
+    cluster: URL của mọi node nếu tracker này là node thứ `node` của một cluster.
+    """
+    env = dict(os.environ,
+               TRACKER_DATA_DIR=work_dir,
+               TRACKER_DB=os.path.join(work_dir, "tracker.db"),
+               TRACKER_LOG_DIR=work_dir)
+    args = [sys.executable, os.path.join(BASE_DIR, "Tracker.py"),
+            "--p", str(port), "--udp-port", "0",
+            "--storage", storage, "--workers", str(workers)]
+    if cluster:
+        args += ["--cluster", ",".join(cluster), "--node", str(node), "--cluster-secret", CLUSTER_SECRET]
+    process = subprocess.Popen(args,
+                               cwd=work_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Tracker exited with code {process.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Tracker did not start in time")
+
+
+def stop_tracker(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def make_torrent(index: int) -> Tuple[str, bytes]:
+    """Tạo một file .torrent hợp lệ (tracker sẽ kiểm tra info_hash). Trả về (info_hash hex, nội dung)."""
+    info = {b"name": f"bench-{index}.bin".encode(),
+            b"length": 4 * 262144,
+            b"piece length": 262144,
+            b"pieces": hashlib.sha1(str(index).encode()).digest() * 4}
+    data = bencodepy.encode({b"announce": b"http://127.0.0.1/announce", b"info": info})
+    return hashlib.sha1(bencodepy.encode(info)).hexdigest(), data
+
+
+def multipart_body(filename: str, data: bytes, name: str) -> bytes:
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + \
+        (f"\r\n--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"name\"\r\n\r\n{name}"
+         f"\r\n--{BOUNDARY}--\r\n").encode()
+
+
+def upload_torrents(port: int, torrents: List[Tuple[str, bytes]]):
+    """Upload trước các torrent để announce/torrent có dữ liệu thật."""
+    for index, (info_hash, data) in enumerate(torrents):
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{port}/announce?port=6881&ip=10.255.255.254&info_hash={info_hash}",
+            data=multipart_body(f"bench-{index}.torrent", data, f"bench-{index}"),
+            headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+        urllib.request.urlopen(request).read()
+
+
+def peer_ip(index: int) -> str:
+    return f"10.{(index >> 16) & 0xff}.{(index >> 8) & 0xff}.{index & 0xff}"
+
+
+async def http_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str,
+                       body: bytes = b"", content_type: Optional[str] = None) -> int:
+    """Gửi một request trên kết nối keep-alive và đọc hết phản hồi. Trả về status code."""
+    head = f"{method} {path} HTTP/1.1\r\nHost: tracker\r\n"
+    if body:
+        head += f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+    writer.write(head.encode() + b"\r\n" + body)
+    header = await reader.readuntil(b"\r\n\r\n")
+    status_line, _, header_lines = header.partition(b"\r\n")
+    length = 0
+    for line in header_lines.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return int(status_line.split(b" ", 2)[1])
+
+
+class BenchConnection:
+    """
+    Một kết nối keep-alive với một nhóm peer giả lập riêng. Mỗi vòng chọn loại request theo
+    trọng số của mix; request cần peer đã tham gia (announce, stopped) chuyển thành started
+    khi nhóm chưa có ai, và ngược lại.
+    """
+
+    def __init__(self, ports: List[int], peer_indexes: range, torrents: List[Tuple[str, bytes]],
+                 mix: Dict[str, float], latencies: Dict[str, List[float]], errors: Dict[str, int]):
+        self.ports = ports
+        self.idle = list(peer_indexes)
+        self.joined: List[int] = []
+        self.torrents = torrents
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.latencies = latencies
+        self.errors = errors
+
+    def _info_hash(self, index: int) -> str:
+        return self.torrents[index % len(self.torrents)][0]
+
+    def _announce_path(self, index: int, event: Optional[str]) -> str:
+        # Một phần tư số peer là seeder, còn lại là leecher
+        left = 0 if index % 4 == 0 else 1048576
+        path = (f"/announce?info_hash={self._info_hash(index)}&port=6881&ip={peer_ip(index)}"
+                f"&compact=1&numwant=50&left={left}")
+        return path + f"&event={event}" if event else path
+
+    def _node(self, info_hash: str) -> int:
+        return owner_of(info_hash, len(self.ports))
+
+    def _next_request(self) -> Tuple[str, int, str, str, bytes]:
+        """Trả về (loại request, node nhận request, method, path, body)."""
+        operation = random.choices(self.operations, self.weights)[0]
+        if operation in ("announce", "stopped") and not self.joined:
+            operation = "started"
+        if operation == "started" and not self.idle:
+            operation = "announce"
+        if operation == "started":
+            index = self.idle.pop(random.randrange(len(self.idle)))
+            self.joined.append(index)
+            return operation, self._node(self._info_hash(index)), "GET", self._announce_path(index, "started"), b""
+        if operation == "announce":
+            index = random.choice(self.joined)
+            return operation, self._node(self._info_hash(index)), "GET", self._announce_path(index, None), b""
+        if operation == "stopped":
+            position = random.randrange(len(self.joined))
+            self.joined[position], self.joined[-1] = self.joined[-1], self.joined[position]
+            index = self.joined.pop()
+            self.idle.append(index)
+            return operation, self._node(self._info_hash(index)), "GET", self._announce_path(index, "stopped"), b""
+        torrent_index = random.randrange(len(self.torrents))
+        info_hash, data = self.torrents[torrent_index]
+        node = self._node(info_hash)
+        if operation == "scrape":
+            return operation, node, "GET", f"/scrape?info_hash={info_hash}", b""
+        if operation == "catalog":
+            # Mọi node đều có đủ danh mục
+            return operation, random.randrange(len(self.ports)), "GET", "/torrents?limit=100", b""
+        if operation == "torrent":
+            return operation, node, "GET", f"/torrents/{info_hash}", b""
+        body = multipart_body(f"bench-{torrent_index}.torrent", data, f"bench-{torrent_index}")
+        return operation, node, "POST", f"/announce?port=6881&ip=10.255.255.254&info_hash={info_hash}", body
+
+    async def run(self, deadline: float):
+        # Một kết nối keep-alive tới mỗi node
+        streams = [await asyncio.open_connection("127.0.0.1", port) for port in self.ports]
+        try:
+            while time.monotonic() < deadline:
+                operation, node, method, path, body = self._next_request()
+                reader, writer = streams[node]
+                started = time.perf_counter()
+                status = await http_request(reader, writer, method, path, body,
+                                            f"multipart/form-data; boundary={BOUNDARY}")
+                self.latencies[operation].append(time.perf_counter() - started)
+                # POST /announce trả về 302 chuyển tới GET /announce
+                if status not in (200, 302):
+                    self.errors[operation] += 1
+        finally:
+            for _, writer in streams:
+                writer.close()
+
+
+def run_client(ports: List[int], first_peer: int, peers: int, connections: int, swarms: int,
+               mix: Dict[str, float], duration: float) -> Tuple[Dict[str, List[float]], Dict[str, int]]:
+    """Entry point của một client process: chia `peers` peer cho `connections` kết nối."""
+    async def run():
+        torrents = [make_torrent(index) for index in range(swarms)]
+        latencies: Dict[str, List[float]] = {operation: [] for operation in OPERATIONS}
+        errors: Dict[str, int] = {operation: 0 for operation in OPERATIONS}
+        deadline = time.monotonic() + duration
+        per_connection = max(1, peers // connections)
+        bench_connections = [
+            BenchConnection(ports, range(first_peer + i * per_connection, first_peer + (i + 1) * per_connection),
+                            torrents, mix, latencies, errors)
+            for i in range(connections)]
+        results = await asyncio.gather(*(connection.run(deadline) for connection in bench_connections),
+                                       return_exceptions=True)
+        errors["connection"] = sum(isinstance(result, Exception) for result in results)
+        return latencies, errors
+    return asyncio.run(run())
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    return {"requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0}
+
+
+def run_load(workers: int, clients: int, connections: int, swarms: int, peers: int,
+             duration: float, mix: Optional[Dict[str, float]] = None, storage: str = "sqlite",
+             nodes: int = 1) -> Dict[str, Any]:
+    mix = mix or parse_mix(DEFAULT_MIX)
+    ports = [free_port() for _ in range(nodes)]
+    cluster = [f"http://127.0.0.1:{port}" for port in ports] if nodes > 1 else None
+    with tempfile.TemporaryDirectory() as work_dir:
+        trackers = []
+        try:
+            for node, port in enumerate(ports):
+                node_dir = os.path.join(work_dir, f"node-{node}")
+                os.makedirs(node_dir)
+                trackers.append(start_tracker(port, workers, node_dir, storage, cluster, node))
+            # Upload lên mọi node để không phải chờ cluster tự phát tán danh mục
+            for port in ports:
+                upload_torrents(port, [make_torrent(index) for index in range(swarms)])
+            # Các worker khác cần một chu kỳ sync để thấy các torrent vừa upload
+            if workers > 1:
+                time.sleep(2)
+            peers_per_client = peers // clients
+            args = [(ports, i * peers_per_client, peers_per_client, connections, swarms, mix, duration)
+                    for i in range(clients)]
+            with multiprocessing.Pool(clients) as pool:
+                started = time.monotonic()
+                results = pool.starmap(run_client, args)
+                elapsed = time.monotonic() - started
+        finally:
+            for tracker in trackers:
+                stop_tracker(tracker)
+    all_latencies: List[float] = []
+    total_errors = 0
+    operations = {}
+    for operation in OPERATIONS:
+        latencies = [value for result_latencies, _ in results for value in result_latencies[operation]]
+        errors = sum(result_errors[operation] for _, result_errors in results)
+        all_latencies += latencies
+        total_errors += errors
+        if latencies or errors:
+            operations[operation] = summarize(latencies, errors, elapsed)
+    total = summarize(all_latencies, total_errors, elapsed)
+    total["connection_errors"] = sum(result_errors["connection"] for _, result_errors in results)
+    return {"nodes": nodes, "workers": workers, "seconds": round(elapsed, 3), "total": total, "operations": operations}
+
+
+@click.command()
+@click.option("--workers", "workers", default="1,2,4", help="Comma separated worker counts to measure")
+@click.option("--nodes", "nodes", default="1", help="Comma separated cluster sizes to measure (trackers on localhost)")
+@click.option("--storage", "storage", default="sqlite", type=click.Choice(["json", "sqlite"]),
+              help="Tracker storage backend (json only supports a single worker)")
+@click.option("--duration", "duration", default=10.0, help="Seconds of load per worker count")
+@click.option("--clients", "clients", default=max(1, (os.cpu_count() or 2) // 2), help="Client processes")
+@click.option("--connections", "connections", default=32, help="Keep-alive connections per client process")
+@click.option("--swarms", "swarms", default=100, help="Number of distinct torrents / swarms")
+@click.option("--peers", "peers", default=20000, help="Number of simulated peers")
+@click.option("--mix", "mix", default=DEFAULT_MIX, help="Request mix as operation=weight pairs")
+@click.option("--output", "output", default=None, type=click.Path(dir_okay=False),
+              help="Also write the JSON report to this file")
+def main(workers: str, nodes: str, storage: str, duration: float, clients: int, connections: int, swarms: int,
+         peers: int, mix: str, output: Optional[str]):
+    request_mix = parse_mix(mix)
+    results: List[Dict[str, Any]] = []
+    for node_count in [int(value) for value in nodes.split(",")]:
+        for count in [int(value) for value in workers.split(",")]:
+            results.append(run_load(count, clients, connections, swarms, peers, duration, request_mix, storage,
+                                    node_count))
+            total = results[-1]["total"]
+            print(f"nodes={node_count} workers={count}: {total['rps']} req/s, "
+                  f"p50 {total['p50_ms']} ms, p99 {total['p99_ms']} ms", file=sys.stderr)
+    baseline = results[0]["total"]["rps"] or 1
+    for result in results:
+        result["speedup"] = round(result["total"]["rps"] / baseline, 2)
+    report = json.dumps({"cpu_count": os.cpu_count(), "storage": storage, "clients": clients,
+                         "connections": connections, "swarms": swarms, "peers": peers,
+                         "duration": duration, "mix": request_mix, "results": results}, indent=4)
+    print(report)
+    if output:
+        with open(output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import hashlib
+import json
+from bisect import bisect_right, insort
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+TRIGRAM = 3
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + TRIGRAM] for i in range(len(text) - TRIGRAM + 1)}
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Kiểm tra header If-None-Match (có thể chứa nhiều ETag hoặc "*") có khớp ETag hiện tại không."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+class TorrentFileCache:
+    """
+    Cache LRU nội dung file .torrent theo info_hash, giới hạn theo tổng số byte.
+    File lớn hơn cả giới hạn không được cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, info_hash: str) -> Optional[bytes]:
+        data = self._items.get(info_hash)
+        if data is not None:
+            self._items.move_to_end(info_hash)
+        return data
+
+    def put(self, info_hash: str, data: bytes):
+        self.invalidate(info_hash)
+        if len(data) > self.max_bytes:
+            return
+        self._items[info_hash] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self._size -= len(evicted)
+
+    def invalidate(self, info_hash: str):
+        data = self._items.pop(info_hash, None)
+        if data is not None:
+            self._size -= len(data)
+
+
+class TorrentCatalog:
+    """
+    Danh mục torrent trong bộ nhớ của tracker: {info_hash: {"file_path", "name", "description"}}.
+    Các chỉ mục được dựng sẵn và cập nhật mỗi lần put():
+        _hashes   : danh sách info_hash đã sắp xếp, phân trang bằng cursor = info_hash cuối của trang trước
+        _trigrams : {trigram: {info_hash}}, tìm chuỗi con mà không cần duyệt cả danh mục
+    Query ngắn hơn một trigram không dùng được chỉ mục: page() duyệt _hashes từ cursor và dừng
+    ngay khi đủ một trang, nên mỗi trang chỉ tốn phần danh mục tới kết quả cuối của trang đó.
+    Body JSON của toàn bộ danh mục (không có file_path) được cache cùng ETag và chỉ bị
+    huỷ khi danh mục thay đổi.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._hashes: List[str] = []
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._full_body: Optional[Tuple[bytes, str]] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, info_hash: str) -> bool:
+        return info_hash in self._entries
+
+    def get(self, info_hash: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get(info_hash)
+
+    def load(self, entries: Dict[str, Dict[str, Any]]):
+        """Nạp lại toàn bộ danh mục (ví dụ từ TORRENT_FILE) và dựng lại các chỉ mục."""
+        self._entries = {}
+        self._hashes = []
+        self._trigrams = {}
+        for info_hash, entry in entries.items():
+            self.put(info_hash, entry.get("file_path"), entry.get("name"), entry.get("description"))
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """Trả về danh mục đầy đủ (có file_path) để ghi xuống đĩa."""
+        return {info_hash: dict(entry) for info_hash, entry in self._entries.items()}
+
+    def put(self, info_hash: str, file_path: str, name: Optional[str], description: Optional[str]):
+        """Thêm hoặc cập nhật một torrent, cập nhật các chỉ mục và huỷ body đã cache."""
+        old_entry = self._entries.get(info_hash)
+        if old_entry is None:
+            insort(self._hashes, info_hash)
+        else:
+            self._unindex_name(info_hash, old_entry.get("name"))
+        self._entries[info_hash] = {"file_path": file_path, "name": name, "description": description}
+        self._index_name(info_hash, name)
+        self._full_body = None
+
+    def _index_name(self, info_hash: str, name: Optional[str]):
+        lowered = (name or "").lower()
+        for trigram in _trigrams(lowered):
+            self._trigrams.setdefault(trigram, set()).add(info_hash)
+
+    def _unindex_name(self, info_hash: str, name: Optional[str]):
+        lowered = (name or "").lower()
+        for trigram in _trigrams(lowered):
+            bucket = self._trigrams.get(trigram)
+            if bucket is not None:
+                bucket.discard(info_hash)
+                if not bucket:
+                    del self._trigrams[trigram]
+
+    def _public(self, info_hashes: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        # Loại bỏ thông tin "file_path" để ẩn thông tin nội bộ
+        return {info_hash: {"name": self._entries[info_hash]["name"],
+                            "description": self._entries[info_hash]["description"]}
+                for info_hash in info_hashes}
+
+    def _search(self, query: str) -> List[str]:
+        """
+        Trả về info_hash (đã sắp xếp) của các torrent có tên chứa query (không phân biệt hoa thường),
+        query phải dài ít nhất một trigram.
+        """
+        query = query.lower()
+        buckets = [self._trigrams.get(trigram) for trigram in _trigrams(query)]
+        if not all(buckets):
+            return []
+        buckets.sort(key=len)
+        candidates = set(buckets[0]).intersection(*buckets[1:])
+        # Trigram chỉ lọc ứng viên, vẫn cần kiểm tra chuỗi con thực sự
+        return sorted(info_hash for info_hash in candidates
+                      if query in (self._entries[info_hash]["name"] or "").lower())
+
+    def full_body(self) -> Tuple[bytes, str]:
+        """Body JSON của toàn bộ danh mục cùng ETag, được cache đến lần put() tiếp theo."""
+        if self._full_body is None:
+            body = json.dumps(self._public(self._entries)).encode("utf-8")
+            self._full_body = (body, make_etag(body))
+        return self._full_body
+
+    def page(self, limit: Optional[int] = None, cursor: Optional[str] = None,
+             search: Optional[str] = None) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        """
+        Trả về (một trang danh mục, cursor của trang tiếp theo hoặc None).
+        Trang gồm tối đa `limit` torrent có info_hash lớn hơn `cursor`, lọc theo `search` nếu có
+        (tên chứa `search`, không phân biệt hoa thường).
+        """
+        if search and len(search) < TRIGRAM:
+            return self._scan_page(search.lower(), limit, cursor)
+        hashes = self._search(search) if search else self._hashes
+        start = bisect_right(hashes, cursor) if cursor else 0
+        end = len(hashes) if limit is None else min(len(hashes), start + limit)
+        selected = hashes[start:end]
+        next_cursor = selected[-1] if selected and end < len(hashes) else None
+        return self._public(selected), next_cursor
+
+    def _scan_page(self, query: str, limit: Optional[int],
+                   cursor: Optional[str]) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        """page() cho query ngắn hơn một trigram: duyệt tên theo thứ tự info_hash tới kết quả thứ limit + 1."""
+        start = bisect_right(self._hashes, cursor) if cursor else 0
+        selected = []
+        for info_hash in islice(self._hashes, start, None):
+            if query in (self._entries[info_hash]["name"] or "").lower():
+                if limit is not None and len(selected) == limit:
+                    return self._public(selected), selected[-1]
+                selected.append(info_hash)
+        return self._public(selected), None
@@ -0,0 +1,76 @@
+import hashlib
+from typing import List, Tuple
+
+KEY_BITS = 32 # Số bit đầu của info_hash dùng để chia vùng
+
+
+def partition_key(info_hash: str) -> int:
+    """32 bit đầu của info_hash (hex). Chuỗi không phải hex được băm lại bằng SHA-1 để vẫn có một vùng."""
+    try:
+        if len(info_hash) >= KEY_BITS // 4:
+            return int(info_hash[:KEY_BITS // 4], 16)
+    except ValueError:
+        pass
+    return int.from_bytes(hashlib.sha1(info_hash.encode("utf-8")).digest()[:KEY_BITS // 8], "big")
+
+
+def owner_of(info_hash: str, node_count: int) -> int:
+    """Node sở hữu info_hash: không gian 32 bit được chia thành node_count vùng liên tiếp bằng nhau."""
+    return (partition_key(info_hash) * node_count) >> KEY_BITS
+
+
+class Cluster:
+    """
+    Cấu hình cluster tracker: danh sách URL của các node (theo cùng thứ tự trên mọi node)
+    và vị trí của node này trong danh sách.
+    Mỗi node sở hữu một vùng info_hash và gửi các thay đổi của vùng đó sang node kế tiếp
+    (successor), là replica của nó. Khi node sở hữu bị đánh dấu down, replica phục vụ
+    thay vùng của node đó.
+    """
+
+    def __init__(self, nodes: List[str], index: int):
+        if not 0 <= index < len(nodes):
+            raise ValueError(f"Node index {index} is outside the cluster of {len(nodes)} nodes.")
+        self.nodes = [node.rstrip("/") for node in nodes]
+        self.index = index
+        # Trạng thái của từng node theo health check gần nhất; node này luôn được coi là sống
+        self.alive = [True] * len(nodes)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def url(self) -> str:
+        return self.nodes[self.index]
+
+    @property
+    def successor(self) -> int:
+        return (self.index + 1) % len(self.nodes)
+
+    def owner(self, info_hash: str) -> int:
+        return owner_of(info_hash, len(self.nodes))
+
+    def owns(self, info_hash: str) -> bool:
+        return self.owner(info_hash) == self.index
+
+    def route(self, info_hash: str) -> int:
+        """Node phục vụ info_hash: node sở hữu, hoặc replica của nó khi node sở hữu down."""
+        owner = self.owner(info_hash)
+        if self.alive[owner]:
+            return owner
+        replica = (owner + 1) % len(self.nodes)
+        return replica if self.alive[replica] else owner
+
+    def key_range(self, node: int) -> Tuple[str, str]:
+        """Vùng [đầu, cuối] (8 ký tự hex đầu của info_hash) mà node sở hữu."""
+        count = len(self.nodes)
+        first = -(-(node << KEY_BITS) // count)
+        last = -(-((node + 1) << KEY_BITS) // count) - 1
+        return f"{first:08x}", f"{last:08x}"
+
+    def set_alive(self, node: int, alive: bool) -> bool:
+        """Cập nhật trạng thái của một node khác. Trả về True nếu trạng thái thay đổi."""
+        if node == self.index or self.alive[node] == alive:
+            return False
+        self.alive[node] = alive
+        return True
@@ -0,0 +1,82 @@
+import atexit
+import copy
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_QUEUE_SIZE = 10000 # Số bản ghi tối đa đang chờ ghi; khi đầy thì bỏ bớt thay vì chặn request
+
+
+def parse_sample_rates(spec: Optional[str]) -> Dict[str, float]:
+    """Đọc cấu hình sampling dạng "announce=0.01,upload=1" thành {event: tỉ lệ giữ lại}."""
+    rates = {}
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Chỉ giữ lại một phần bản ghi của các sự kiện lặp lại nhiều (ví dụ mỗi announce).
+    Bản ghi gắn sự kiện qua extra={"event": "<tên>"}; bản ghi không có event hoặc từ
+    WARNING trở lên luôn được giữ.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler với queue có giới hạn: khi queue đầy, bản ghi bị bỏ và được đếm lại."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Chỉ ghép message với args; định dạng đầy đủ (thời gian, level...) do thread của listener làm
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = logging.Formatter().formatException(record.exc_info) if record.exc_info else None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(log_file_path: str, level: str = "INFO",
+                  sample_rates: Optional[Dict[str, float]] = None) -> DroppingQueueHandler:
+    """
+    Cấu hình root logger: request chỉ đẩy bản ghi vào một queue có giới hạn, còn việc
+    định dạng và ghi file do QueueListener làm trên một thread riêng, nên việc ghi log
+    không bao giờ chặn event loop. Listener được dừng (và ghi nốt queue) khi process thoát.
+    """
+    file_handler = logging.FileHandler(log_file_path, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter(sample_rates or {}))
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
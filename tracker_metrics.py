@@ -0,0 +1,163 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Bucket (giây) cho độ trễ request và thời gian flush storage
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Bộ đếm tăng dần theo nhãn. Mọi cập nhật đều chạy trên event loop của tracker
+    (handler HTTP, UDP và các task nền) nên chỉ là một phép cộng vào dict, không cần lock.
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = {}
+        if not self.labelnames:
+            # Metric không có nhãn luôn được xuất (giá trị 0) ngay cả khi chưa có sự kiện nào
+            self.values[()] = 0
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge:
+    """Giá trị tức thời, chỉ được tính (qua callback) khi /metrics được gọi nên không tốn gì trên đường request."""
+
+    def __init__(self, name: str, help_text: str, collect: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {_format_value(self.collect())}"
+
+
+class Histogram:
+    """
+    Histogram với bucket cố định. Mỗi observe chỉ là một bisect và vài phép cộng;
+    số đếm theo bucket được lưu không cộng dồn và chỉ cộng dồn khi render.
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # {labels: [số đếm theo bucket (+ bucket +Inf), tổng, số lần]}
+        self.values: Dict[Labels, List] = {}
+        if not self.labelnames:
+            self.values[()] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value: float, *labels: str):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            plain_labels = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{plain_labels} {_format_value(total)}"
+            yield f"{self.name}_count{plain_labels} {count}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List = []
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, help_text, collect))
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Toàn bộ metric theo Prometheus text format 0.0.4."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware đếm request và đo độ trễ theo route. Nhãn route là path template của
+    route FastAPI (ví dụ /torrents/{info_hash}) chứ không phải URL thật, để số chuỗi nhãn
+    luôn có giới hạn; request không khớp route nào được gộp vào "unmatched".
+    """
+
+    def __init__(self, app, requests: Counter, latency: Histogram):
+        self.app = app
+        self.requests = requests
+        self.latency = latency
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            self.requests.inc(route_path, scope["method"], str(status_code))
+            self.latency.observe(time.perf_counter() - started, route_path)
@@ -0,0 +1,257 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+PeerChanges = Dict[Tuple[str, Tuple[str, int]], Optional[bool]]
+# {(info_hash, (ip, port)): True/False = seeder/leecher, None = peer đã bị xoá}
+TorrentChanges = Dict[str, Dict[str, Any]]
+# {info_hash: {"file_path", "name", "description"}}
+
+
+class Storage(ABC):
+    """
+    Lớp lưu trữ trạng thái tracker (danh mục torrent và registry peers).
+    Registry trong bộ nhớ vẫn là nguồn dữ liệu chính; storage chỉ nạp lúc khởi động
+    và nhận các thay đổi được gom lại theo lô. Mọi phương thức đều là blocking I/O,
+    Tracker gọi chúng qua asyncio.to_thread.
+    Backend có incremental = True chỉ cần các thay đổi; backend còn lại nhận thêm
+    snapshot đầy đủ để ghi lại cả file.
+    Backend thiếu một phương thức abstract sẽ lỗi ngay khi khởi tạo.
+    """
+    incremental = False
+
+    @abstractmethod
+    def sync(self) -> Tuple[List[Tuple[str, Tuple[str, int], Optional[bool]]], TorrentChanges]:
+        """
+        Trả về các thay đổi do worker khác ghi kể từ lần sync trước:
+        ([(info_hash, peer_key, seed hoặc None nếu đã xoá)], {info_hash: entry}).
+        """
+
+    @abstractmethod
+    def load_torrents(self) -> Dict[str, Dict[str, Any]]:
+        """Trả về {info_hash: {"file_path", "name", "description"}}."""
+
+    @abstractmethod
+    def load_peers(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Trả về {info_hash: [{"ip", "port", "seed"}]}."""
+
+    @abstractmethod
+    def save_torrents(self, changes: TorrentChanges, snapshot: Optional[Dict[str, Dict[str, Any]]]):
+        """Ghi các torrent thay đổi (snapshot là cả danh mục, None với backend incremental)."""
+
+    @abstractmethod
+    def save_peers(self, changes: PeerChanges, snapshot: Optional[Dict[str, List[Dict[str, Any]]]]):
+        """Ghi các thay đổi peer (snapshot là cả registry, None với backend incremental)."""
+
+    def close(self):
+        pass
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json_atomic(path: str, data):
+    """
+    Ghi JSON ra file tạm rồi os.replace để file đích không bao giờ bị ghi dở.
+    Mỗi lần ghi có file tạm riêng, nên hai lần ghi đồng thời không giẫm lên file tạm của nhau.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=name + ".", suffix=".tmp", delete=False) as f:
+        try:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+class JsonStorage(Storage):
+    """Backend mặc định: hai file JSON (TORRENT_FILE, PEER_FILE), mỗi lần ghi là ghi lại cả file."""
+
+    def __init__(self, torrent_file: str, peer_file: str):
+        self.torrent_file = torrent_file
+        self.peer_file = peer_file
+
+    def sync(self) -> Tuple[List[Tuple[str, Tuple[str, int], Optional[bool]]], TorrentChanges]:
+        # File JSON chỉ dùng với một worker nên không có thay đổi của worker khác để đọc
+        return [], {}
+
+    def load_torrents(self) -> Dict[str, Dict[str, Any]]:
+        return _read_json(self.torrent_file)
+
+    def load_peers(self) -> Dict[str, List[Dict[str, Any]]]:
+        return _read_json(self.peer_file)
+
+    def save_torrents(self, changes: TorrentChanges, snapshot: Optional[Dict[str, Dict[str, Any]]]):
+        write_json_atomic(self.torrent_file, snapshot)
+
+    def save_peers(self, changes: PeerChanges, snapshot: Optional[Dict[str, List[Dict[str, Any]]]]):
+        write_json_atomic(self.peer_file, snapshot)
+
+
+class SQLiteStorage(Storage):
+    """
+    Backend SQLite ở chế độ WAL: mỗi lô thay đổi là một transaction duy nhất gồm các câu
+    lệnh executemany với SQL cố định (sqlite3 tự cache prepared statement), nên chi phí
+    ghi tỉ lệ với số thay đổi chứ không phải kích thước toàn bộ registry.
+    Kết nối được dùng chung giữa các thread của asyncio.to_thread và được bảo vệ bằng lock.
+
+    Khi có worker_id (chế độ nhiều worker), mỗi thay đổi còn được ghi thêm vào peer_log /
+    torrent_log để các worker khác đọc lại bằng sync(). Mô hình nhất quán là eventual:
+    một worker thấy ngay thay đổi của chính nó, còn thay đổi của worker khác chỉ thấy sau
+    khi worker kia flush và worker này sync. Áp dụng lại một bản ghi log là idempotent nên
+    cursor được chụp trước khi nạp trạng thái: có thể đọc trùng nhưng không bỏ sót.
+    """
+    incremental = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS torrents (
+            info_hash   TEXT PRIMARY KEY,
+            file_path   TEXT NOT NULL,
+            name        TEXT,
+            description TEXT
+        );
+        CREATE TABLE IF NOT EXISTS peers (
+            info_hash TEXT NOT NULL,
+            ip        TEXT NOT NULL,
+            port      INTEGER NOT NULL,
+            seed      INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (info_hash, ip, port)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS peer_log (
+            seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+            worker_id TEXT NOT NULL,
+            created   REAL NOT NULL,
+            info_hash TEXT NOT NULL,
+            ip        TEXT NOT NULL,
+            port      INTEGER NOT NULL,
+            seed      INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS torrent_log (
+            seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+            worker_id TEXT NOT NULL,
+            created   REAL NOT NULL,
+            info_hash TEXT NOT NULL
+        );
+    """
+    UPSERT_TORRENT = ("INSERT INTO torrents (info_hash, file_path, name, description) VALUES (?, ?, ?, ?) "
+                      "ON CONFLICT(info_hash) DO UPDATE SET file_path = excluded.file_path, "
+                      "name = excluded.name, description = excluded.description")
+    UPSERT_PEER = ("INSERT INTO peers (info_hash, ip, port, seed) VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT(info_hash, ip, port) DO UPDATE SET seed = excluded.seed")
+    DELETE_PEER = "DELETE FROM peers WHERE info_hash = ? AND ip = ? AND port = ?"
+    LOG_PEER = "INSERT INTO peer_log (worker_id, created, info_hash, ip, port, seed) VALUES (?, ?, ?, ?, ?, ?)"
+    LOG_TORRENT = "INSERT INTO torrent_log (worker_id, created, info_hash) VALUES (?, ?, ?)"
+    READ_PEER_LOG = "SELECT seq, info_hash, ip, port, seed FROM peer_log WHERE seq > ? AND worker_id != ? ORDER BY seq"
+    READ_TORRENT_LOG = ("SELECT l.seq, t.info_hash, t.file_path, t.name, t.description FROM torrent_log l "
+                        "JOIN torrents t ON t.info_hash = l.info_hash WHERE l.seq > ? AND l.worker_id != ? ORDER BY l.seq")
+    LOG_RETENTION = 600 # Giây giữ lại bản ghi log, đủ lâu hơn nhiều so với chu kỳ sync của mọi worker
+
+    def __init__(self, path: str, worker_id: Optional[str] = None):
+        self.path = path
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Đặt busy_timeout trước để nhiều worker khởi động cùng lúc chờ nhau thay vì lỗi "locked"
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: commit không fsync, dữ liệu vẫn nhất quán sau khi crash
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+        self._peer_cursor = self._max_seq("peer_log")
+        self._torrent_cursor = self._max_seq("torrent_log")
+        self._last_trim = time.monotonic()
+
+    def _max_seq(self, table: str) -> int:
+        return self._connection.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {table}").fetchone()[0]
+
+    def load_torrents(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT info_hash, file_path, name, description FROM torrents").fetchall()
+        return {info_hash: {"file_path": file_path, "name": name, "description": description}
+                for info_hash, file_path, name, description in rows}
+
+    def load_peers(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            rows = self._connection.execute("SELECT info_hash, ip, port, seed FROM peers").fetchall()
+        peer_dict: Dict[str, List[Dict[str, Any]]] = {}
+        for info_hash, ip, port, seed in rows:
+            peer_dict.setdefault(info_hash, []).append({"ip": ip, "port": port, "seed": bool(seed)})
+        return peer_dict
+
+    def save_torrents(self, changes: TorrentChanges, snapshot: Optional[Dict[str, Dict[str, Any]]]):
+        rows = [(info_hash, entry["file_path"], entry["name"], entry["description"])
+                for info_hash, entry in changes.items()]
+        with self._lock, self._transaction():
+            self._connection.executemany(self.UPSERT_TORRENT, rows)
+            if self.worker_id:
+                now = time.time()
+                self._connection.executemany(self.LOG_TORRENT,
+                                             [(self.worker_id, now, info_hash) for info_hash in changes])
+
+    def save_peers(self, changes: PeerChanges, snapshot: Optional[Dict[str, List[Dict[str, Any]]]]):
+        upserts = []
+        deletes = []
+        for (info_hash, (ip, port)), seed in changes.items():
+            if seed is None:
+                deletes.append((info_hash, ip, port))
+            else:
+                upserts.append((info_hash, ip, port, int(seed)))
+        with self._lock, self._transaction():
+            self._connection.executemany(self.DELETE_PEER, deletes)
+            self._connection.executemany(self.UPSERT_PEER, upserts)
+            if self.worker_id:
+                now = time.time()
+                self._connection.executemany(
+                    self.LOG_PEER,
+                    [(self.worker_id, now, info_hash, ip, port, None if seed is None else int(seed))
+                     for (info_hash, (ip, port)), seed in changes.items()])
+
+    def sync(self) -> Tuple[List[Tuple[str, Tuple[str, int], Optional[bool]]], TorrentChanges]:
+        if not self.worker_id:
+            return [], {}
+        with self._lock:
+            peer_rows = self._connection.execute(self.READ_PEER_LOG, (self._peer_cursor, self.worker_id)).fetchall()
+            torrent_rows = self._connection.execute(self.READ_TORRENT_LOG,
+                                                    (self._torrent_cursor, self.worker_id)).fetchall()
+            if peer_rows:
+                self._peer_cursor = peer_rows[-1][0]
+            if torrent_rows:
+                self._torrent_cursor = torrent_rows[-1][0]
+            if time.monotonic() - self._last_trim > self.LOG_RETENTION:
+                self._trim_logs()
+        peer_changes = [(info_hash, (ip, port), None if seed is None else bool(seed))
+                        for _, info_hash, ip, port, seed in peer_rows]
+        torrent_changes = {info_hash: {"file_path": file_path, "name": name, "description": description}
+                           for _, info_hash, file_path, name, description in torrent_rows}
+        return peer_changes, torrent_changes
+
+    def _trim_logs(self):
+        cutoff = time.time() - self.LOG_RETENTION
+        with self._transaction():
+            for table in ("peer_log", "torrent_log"):
+                self._connection.execute(f"DELETE FROM {table} WHERE created < ?", (cutoff,))
+        self._last_trim = time.monotonic()
+
+    def _transaction(self):
+        # Với isolation_level=None, "with connection" chỉ commit/rollback, nên BEGIN phải gọi tường minh.
+        # BEGIN IMMEDIATE tuần tự hoá các writer, nên seq của log tăng đúng theo thứ tự commit.
+        self._connection.execute("BEGIN IMMEDIATE")
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,333 @@
+import ipaddress
+import json
+import random
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+PeerKey = Tuple[str, int] # (ip, port)
+
+
+def pack_peers(peer_keys) -> Tuple[bytes, bytes]:
+    """
+    Đóng gói danh sách peer theo định dạng compact (BEP 23 / BEP 7):
+    mỗi peer IPv4 là 4 byte IP + 2 byte port, mỗi peer IPv6 là 16 byte IP + 2 byte port.
+    Peer có địa chỉ không phải IP (ví dụ hostname) bị bỏ qua.
+    Trả về (peers, peers6).
+    """
+    peers4 = bytearray()
+    peers6 = bytearray()
+    for ip, port in peer_keys:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            continue
+        target = peers4 if address.version == 4 else peers6
+        target += address.packed
+        target += port.to_bytes(2, "big")
+    return bytes(peers4), bytes(peers6)
+
+
+class PackedPeers:
+    """
+    Một danh sách peer đã được mã hoá sẵn, để nhiều phản hồi announce dùng lại mà không
+    phải duyệt và mã hoá lại từng peer:
+        compact4 / compact6 : định dạng compact (BEP 23 / BEP 7), 6 / 18 byte mỗi peer
+        json                : các phần tử {"ip": ..., "port": ...} nối bằng dấu phẩy
+    Peer được xếp theo thứ tự IPv4, IPv6 rồi tới địa chỉ không phải IP (chỉ có trong JSON),
+    nên mọi phản hồi (bỏ người hỏi, cắt theo numwant) chỉ là vài phép cắt bytes.
+    """
+    __slots__ = ("keys", "positions", "count4", "count6", "compact4", "compact6", "json", "json_ends")
+
+    def __init__(self, peer_keys: Iterable[PeerKey]):
+        groups: Tuple[List, List, List] = ([], [], [])
+        for ip, port in peer_keys:
+            try:
+                address = ipaddress.ip_address(ip)
+            except ValueError:
+                groups[2].append(((ip, port), b""))
+                continue
+            groups[0 if address.version == 4 else 1].append(((ip, port), address.packed + port.to_bytes(2, "big")))
+        entries = groups[0] + groups[1] + groups[2]
+        self.keys: List[PeerKey] = [key for key, _ in entries]
+        self.positions: Dict[PeerKey, int] = {key: position for position, key in enumerate(self.keys)}
+        self.count4 = len(groups[0])
+        self.count6 = len(groups[1])
+        self.compact4 = b"".join(packed for _, packed in groups[0])
+        self.compact6 = b"".join(packed for _, packed in groups[1])
+        fragments = [json.dumps({"ip": ip, "port": port}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                     for ip, port in self.keys]
+        self.json = b",".join(fragments)
+        # Vị trí kết thúc (không gồm dấu phẩy) của phần tử JSON thứ i
+        self.json_ends: List[int] = []
+        end = -1
+        for fragment in fragments:
+            end += len(fragment) + 1
+            self.json_ends.append(end)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def select(self, count: int, exclude: Optional[PeerKey] = None) -> "PeerSelection":
+        """count peer đầu tiên của danh sách, không gồm exclude."""
+        skip = self.positions.get(exclude) if exclude is not None else None
+        if skip is not None and skip >= count:
+            skip = None
+        end = min(len(self.keys), count + (skip is not None))
+        return PeerSelection(self, end, skip)
+
+
+def _cut(blob: bytes, size: int, start: int, end: int, skip: Optional[int]) -> bytes:
+    """Các phần tử [start, end) (mỗi phần tử size byte) của blob, bỏ phần tử thứ skip."""
+    end = max(start, end)
+    if skip is None or not start <= skip < end:
+        return blob[:(end - start) * size]
+    skip -= start
+    return blob[:skip * size] + blob[(skip + 1) * size:(end - start) * size]
+
+
+class PeerSelection:
+    """Các phần tử [0, end) của một PackedPeers, bỏ phần tử thứ skip (người hỏi) nếu có."""
+    __slots__ = ("packed", "end", "skip")
+
+    def __init__(self, packed: PackedPeers, end: int, skip: Optional[int]):
+        self.packed = packed
+        self.end = end
+        self.skip = skip
+
+    def keys(self) -> List[PeerKey]:
+        keys = self.packed.keys[:self.end]
+        if self.skip is not None:
+            del keys[self.skip]
+        return keys
+
+    def compact(self) -> Tuple[bytes, bytes]:
+        """(peers, peers6) theo định dạng compact."""
+        packed = self.packed
+        return (_cut(packed.compact4, 6, 0, min(self.end, packed.count4), self.skip),
+                _cut(packed.compact6, 18, packed.count4, min(self.end, packed.count4 + packed.count6), self.skip))
+
+    def json(self) -> bytes:
+        """Mảng JSON [{"ip", "port"}, ...]."""
+        packed = self.packed
+        if not self.end or (self.end == 1 and self.skip is not None):
+            return b"[]"
+        ends = packed.json_ends
+        body = packed.json[:ends[self.end - 1]]
+        if self.skip is not None:
+            start = ends[self.skip - 1] + 1 if self.skip else 0
+            stop = ends[self.skip] + 1
+            # Bỏ phần tử skip cùng dấu phẩy sau nó (hoặc dấu phẩy trước nó nếu là phần tử cuối)
+            body = body[:start] + body[stop:] if self.skip < self.end - 1 else body[:max(0, start - 1)]
+        return b"[" + body + b"]"
+
+
+Bucket = Tuple # Nhóm mạng của peer, ví dụ (24, <số hiệu mạng /24>) hoặc ("site", <tên site>)
+
+
+def parse_site_prefixes(spec: Optional[str]) -> List[Tuple[str, Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]]:
+    """
+    Đọc danh sách prefix của các site dạng "hn=10.1.0.0/16,hn=10.2.0.0/16,hcm=10.3.0.0/16".
+    Prefix không có tên là một site riêng mang tên chính prefix đó.
+    """
+    sites = []
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        name, _, prefix = item.rpartition("=")
+        network = ipaddress.ip_network(prefix.strip(), strict=False)
+        sites.append((name.strip() or str(network), network))
+    return sites
+
+
+class Locality:
+    """
+    Tính các nhóm mạng của một IP, từ gần tới xa: cùng /24, cùng /16 (IPv6: /64, /48)
+    rồi site (theo site_prefixes). IP không hợp lệ (ví dụ hostname) không thuộc nhóm nào.
+    """
+
+    def __init__(self, site_prefixes: Sequence[Tuple[str, Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]] = ()):
+        self.site_prefixes = list(site_prefixes)
+
+    def buckets(self, ip: str) -> Tuple[Bucket, ...]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return ()
+        value = int(address)
+        if address.version == 4:
+            buckets = [(24, value >> 8), (16, value >> 16)]
+        else:
+            buckets = [(64, value >> 64), (48, value >> 80)]
+        for name, network in self.site_prefixes:
+            if address in network:
+                buckets.append(("site", name))
+                break
+        return tuple(buckets)
+
+
+class PeerList:
+    """
+    Mảng peer kèm chỉ mục {peer_key: vị trí trong mảng}:
+        add     : O(1), thêm vào cuối mảng
+        remove  : O(1), đổi chỗ phần tử cần xoá với phần tử cuối rồi pop (swap-remove)
+        sample  : O(count), chọn ngẫu nhiên theo vị trí mà không cần xáo trộn cả mảng
+    """
+    __slots__ = ("_keys", "_positions")
+
+    def __init__(self):
+        self._keys: List[PeerKey] = []
+        self._positions: Dict[PeerKey, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, peer_key: PeerKey) -> bool:
+        return peer_key in self._positions
+
+    def __iter__(self) -> Iterator[PeerKey]:
+        return iter(self._keys)
+
+    def add(self, peer_key: PeerKey) -> bool:
+        if peer_key in self._positions:
+            return False
+        self._positions[peer_key] = len(self._keys)
+        self._keys.append(peer_key)
+        return True
+
+    def remove(self, peer_key: PeerKey) -> bool:
+        position = self._positions.pop(peer_key, None)
+        if position is None:
+            return False
+        last_key = self._keys.pop()
+        if position < len(self._keys):
+            self._keys[position] = last_key
+            self._positions[last_key] = position
+        return True
+
+    def sample(self, count: int, exclude: Optional[PeerKey] = None) -> List[PeerKey]:
+        """
+        Chọn ngẫu nhiên đều tối đa `count` peer khác `exclude`.
+        Vị trí của `exclude` (nếu có) được bỏ qua bằng cách chọn trong [0, n-1) rồi dịch
+        các vị trí >= vị trí bị loại lên 1, nên chi phí chỉ phụ thuộc vào `count`.
+        """
+        excluded = self._positions.get(exclude) if exclude is not None else None
+        available = len(self._keys) - (excluded is not None)
+        if count >= available:
+            return [key for key in self._keys if key != exclude]
+        if count <= 0:
+            return []
+        positions = random.sample(range(available), count)
+        if excluded is not None:
+            positions = [position + 1 if position >= excluded else position for position in positions]
+        return [self._keys[position] for position in positions]
+
+
+class Swarm:
+    """
+    Tập peer của một info_hash, lưu trong một PeerList (add/remove/sample O(1)/O(count)).
+    Tập seeder được giữ riêng để complete/incomplete luôn có sẵn với chi phí O(1).
+    Mỗi peer còn được xếp sẵn vào các nhóm mạng của nó (Locality.buckets, tính một lần khi
+    peer vào swarm), nên việc ưu tiên peer gần người hỏi khi chọn peer vẫn chỉ tốn O(count).
+    version tăng mỗi khi có peer vào hoặc rời swarm, để biết phản hồi đã cache còn đúng không.
+    """
+    __slots__ = ("_peers", "_seeds", "_buckets", "_peer_buckets", "version")
+
+    def __init__(self):
+        self.version = 0
+        self._peers = PeerList()
+        self._seeds: Set[PeerKey] = set()
+        self._buckets: Dict[Bucket, PeerList] = {}
+        self._peer_buckets: Dict[PeerKey, Tuple[Bucket, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def __contains__(self, peer_key: PeerKey) -> bool:
+        return peer_key in self._peers
+
+    def __iter__(self) -> Iterator[PeerKey]:
+        return iter(self._peers)
+
+    @property
+    def complete(self) -> int:
+        """Số seeder (peer đã có đủ dữ liệu)."""
+        return len(self._seeds)
+
+    @property
+    def incomplete(self) -> int:
+        """Số leecher (peer còn đang tải)."""
+        return len(self._peers) - len(self._seeds)
+
+    def is_seed(self, peer_key: PeerKey) -> bool:
+        return peer_key in self._seeds
+
+    def set_seed(self, peer_key: PeerKey, is_seed: bool) -> bool:
+        """Cập nhật trạng thái seeder của peer đã có trong swarm. Trả về True nếu trạng thái thay đổi."""
+        if peer_key not in self._peers or (peer_key in self._seeds) == is_seed:
+            return False
+        if is_seed:
+            self._seeds.add(peer_key)
+        else:
+            self._seeds.discard(peer_key)
+        return True
+
+    def add(self, peer_key: PeerKey, is_seed: bool = True, buckets: Tuple[Bucket, ...] = ()) -> bool:
+        """Thêm peer vào swarm và vào các nhóm mạng `buckets` của nó. Trả về False nếu peer đã có."""
+        if not self._peers.add(peer_key):
+            return False
+        self.version += 1
+        if is_seed:
+            self._seeds.add(peer_key)
+        if buckets:
+            self._peer_buckets[peer_key] = buckets
+            for bucket in buckets:
+                members = self._buckets.get(bucket)
+                if members is None:
+                    members = self._buckets[bucket] = PeerList()
+                members.add(peer_key)
+        return True
+
+    def remove(self, peer_key: PeerKey) -> bool:
+        """Xoá peer khỏi swarm và các nhóm mạng của nó. Trả về False nếu peer không có trong swarm."""
+        if not self._peers.remove(peer_key):
+            return False
+        self.version += 1
+        self._seeds.discard(peer_key)
+        for bucket in self._peer_buckets.pop(peer_key, ()):
+            members = self._buckets[bucket]
+            members.remove(peer_key)
+            if not members:
+                del self._buckets[bucket]
+        return True
+
+    def sample(self, count: int, exclude: Optional[PeerKey] = None,
+               near: Tuple[Bucket, ...] = (), random_fraction: float = 1.0) -> List[PeerKey]:
+        """
+        Chọn tối đa `count` peer khác `exclude`.
+        Không có `near`: chọn ngẫu nhiên đều trong cả swarm.
+        Có `near` (các nhóm mạng của người hỏi, từ gần tới xa): phần (1 - random_fraction)
+        của count được lấy lần lượt từ các nhóm gần nhất, phần còn lại chọn đều trong cả swarm
+        để danh sách không chỉ gồm peer cùng mạng.
+        """
+        if not near or random_fraction >= 1.0 or count >= len(self._peers) - (exclude in self._peers):
+            return self._peers.sample(count, exclude)
+        local_count = count - int(count * random_fraction)
+        chosen: List[PeerKey] = []
+        seen = {exclude}
+        for bucket in near:
+            if len(chosen) >= local_count:
+                break
+            members = self._buckets.get(bucket)
+            if members is not None:
+                # Chọn dư len(seen) peer để vẫn đủ sau khi bỏ các peer đã chọn từ nhóm hẹp hơn
+                self._take(members.sample(local_count - len(chosen) + len(seen)), local_count, chosen, seen)
+        self._take(self._peers.sample(count - len(chosen) + len(seen)), count, chosen, seen)
+        return chosen
+
+    @staticmethod
+    def _take(candidates: List[PeerKey], limit: int, chosen: List[PeerKey], seen: Set[Optional[PeerKey]]):
+        for peer_key in candidates:
+            if len(chosen) >= limit:
+                return
+            if peer_key not in seen:
+                seen.add(peer_key)
+                chosen.append(peer_key)
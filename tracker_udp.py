@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import ipaddress
+import logging
+import os
+import struct
+import time
+from typing import Callable, List, Optional, Tuple
+
+from tracker_swarm import PeerKey, pack_peers
+
+logger = logging.getLogger("TorrentTracker")
+
+PROTOCOL_ID = 0x41727101980 # Magic constant của BEP 15
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENTS = {0: None, 1: "completed", 2: "started", 3: "stopped"}
+CONNECTION_ID_TTL = 60 # Giây, connection id hợp lệ trong 1-2 chu kỳ (BEP 15 cho phép 2 phút)
+MAX_SCRAPE_HASHES = 74 # Số info_hash tối đa trong một gói scrape (BEP 15)
+
+CONNECT_REQUEST = struct.Struct(">QII") # connection_id, action, transaction_id
+ANNOUNCE_REQUEST = struct.Struct(">QII20s20sQQQIIIiH")
+RESPONSE_HEADER = struct.Struct(">II") # action, transaction_id
+ANNOUNCE_RESPONSE = struct.Struct(">IIIII") # action, transaction_id, interval, leechers, seeders
+SCRAPE_ENTRY = struct.Struct(">III") # seeders, completed, leechers
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    UDP tracker theo BEP 15 (connect / announce / scrape), chạy cùng event loop
+    với ứng dụng FastAPI và dùng chung registry swarm thông qua hai callback:
+        announce(info_hash_hex, peer_key, event, numwant, left) -> List[PeerKey]
+        scrape(info_hash_hex) -> (complete, incomplete, downloaded)
+    Connection id không cần lưu trạng thái: đó là hash có khoá bí mật của địa chỉ
+    client và khoảng thời gian hiện tại, nên có thể kiểm tra lại mà không tốn bộ nhớ.
+    """
+
+    def __init__(self,
+                 announce: Callable[[str, PeerKey, Optional[str], int, int], List[PeerKey]],
+                 scrape: Callable[[str], Tuple[int, int, int]],
+                 interval: int,
+                 secret: Optional[bytes] = None):
+        self.announce = announce
+        self.scrape = scrape
+        self.interval = interval
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self._secret = secret or os.urandom(16)
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def _connection_id(self, addr, epoch: int) -> int:
+        digest = hashlib.blake2b(f"{addr[0]}:{addr[1]}:{epoch}".encode(),
+                                 key=self._secret, digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def _is_valid_connection_id(self, connection_id: int, addr) -> bool:
+        epoch = int(time.time()) // CONNECTION_ID_TTL
+        return connection_id in (self._connection_id(addr, epoch), self._connection_id(addr, epoch - 1))
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            reply = self._handle(data, addr)
+        except Exception as e:
+            logger.error(f"UDP tracker: error handling datagram from {addr}: {e}", exc_info=True)
+            return
+        if reply:
+            self.transport.sendto(reply, addr)
+
+    def _error(self, transaction_id: int, message: str) -> bytes:
+        return RESPONSE_HEADER.pack(ACTION_ERROR, transaction_id) + message.encode("utf-8")
+
+    def _handle(self, data: bytes, addr) -> Optional[bytes]:
+        if len(data) < CONNECT_REQUEST.size:
+            return None
+        connection_id, action, transaction_id = CONNECT_REQUEST.unpack_from(data)
+        if action == ACTION_CONNECT:
+            if connection_id != PROTOCOL_ID:
+                return None
+            epoch = int(time.time()) // CONNECTION_ID_TTL
+            return RESPONSE_HEADER.pack(ACTION_CONNECT, transaction_id) + \
+                struct.pack(">Q", self._connection_id(addr, epoch))
+        if not self._is_valid_connection_id(connection_id, addr):
+            return self._error(transaction_id, "Invalid connection id")
+        if action == ACTION_ANNOUNCE:
+            return self._handle_announce(data, addr, transaction_id)
+        if action == ACTION_SCRAPE:
+            return self._handle_scrape(data, transaction_id)
+        return self._error(transaction_id, "Unknown action")
+
+    def _handle_announce(self, data: bytes, addr, transaction_id: int) -> bytes:
+        if len(data) < ANNOUNCE_REQUEST.size:
+            return self._error(transaction_id, "Announce packet too short")
+        (_, _, _, info_hash, _peer_id, _downloaded, left, _uploaded,
+         event, ip, _key, numwant, port) = ANNOUNCE_REQUEST.unpack_from(data)
+        if event not in EVENTS:
+            return self._error(transaction_id, "Unknown event")
+        peer_ip = str(ipaddress.IPv4Address(ip)) if ip else addr[0]
+        info_hash = info_hash.hex()
+        peer_keys = self.announce(info_hash, (peer_ip, port), EVENTS[event], numwant, left)
+        complete, incomplete, _ = self.scrape(info_hash)
+        peers4, peers6 = pack_peers(peer_keys)
+        # Socket IPv4 trả peer 6 byte, socket IPv6 trả peer 18 byte (BEP 15)
+        is_ipv6 = ":" in addr[0]
+        return ANNOUNCE_RESPONSE.pack(ACTION_ANNOUNCE, transaction_id, self.interval, incomplete, complete) + \
+            (peers6 if is_ipv6 else peers4)
+
+    def _handle_scrape(self, data: bytes, transaction_id: int) -> bytes:
+        hashes = data[CONNECT_REQUEST.size:]
+        count = min(len(hashes) // 20, MAX_SCRAPE_HASHES)
+        reply = bytearray(RESPONSE_HEADER.pack(ACTION_SCRAPE, transaction_id))
+        for i in range(count):
+            complete, incomplete, downloaded = self.scrape(hashes[i * 20:(i + 1) * 20].hex())
+            reply += SCRAPE_ENTRY.pack(complete, downloaded, incomplete)
+        return bytes(reply)
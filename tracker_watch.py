@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from tracker_swarm import PeerKey
+
+MAX_DELTAS = 512 # Số thay đổi gần nhất giữ lại cho mỗi swarm đang được theo dõi
+FEED_TTL = 300 # Giây giữ feed của một swarm sau lần theo dõi cuối cùng
+
+
+class _Feed:
+    __slots__ = ("deltas", "floor", "event", "waiters", "last_used")
+
+    def __init__(self, floor: int):
+        # [(version, peer_key, True nếu peer vào swarm / False nếu rời swarm)], version tăng dần
+        self.deltas: Deque[Tuple[int, PeerKey, bool]] = deque(maxlen=MAX_DELTAS)
+        # Mọi thay đổi có version > floor đều còn trong deltas
+        self.floor = floor
+        self.event = asyncio.Event()
+        self.waiters = 0
+        self.last_used = time.monotonic()
+
+
+class SwarmWatcher:
+    """
+    Theo dõi peer vào/rời swarm cho GET /peers/subscribe (long-poll).
+    Mọi thay đổi được đánh một version tăng dần dùng chung cho cả tracker, nhưng chỉ
+    các swarm đang có người theo dõi mới giữ lại danh sách thay đổi (tối đa MAX_DELTAS).
+    Cursor trả cho client có dạng "<id tracker>.<version>": cursor của process khác
+    (worker khác, tracker đã khởi động lại) hoặc quá cũ đều dẫn tới reset.
+    """
+
+    def __init__(self):
+        self.instance_id = uuid.uuid4().hex[:8]
+        self._versions = itertools.count(1)
+        self.version = 0
+        self._feeds: Dict[str, _Feed] = {}
+
+    @property
+    def waiting(self) -> int:
+        """Số request long-poll đang chờ."""
+        return sum(feed.waiters for feed in self._feeds.values())
+
+    def cursor(self, version: int) -> str:
+        return f"{self.instance_id}.{version}"
+
+    def _parse_cursor(self, cursor: Optional[str]) -> Optional[int]:
+        instance_id, _, version = (cursor or "").partition(".")
+        if instance_id != self.instance_id or not version.isdigit():
+            return None
+        version = int(version)
+        return version if version <= self.version else None
+
+    def publish(self, info_hash: str, peer_key: PeerKey, joined: bool):
+        """Ghi nhận một peer vào (joined=True) hoặc rời swarm và đánh thức các request đang chờ."""
+        self.version = next(self._versions)
+        feed = self._feeds.get(info_hash)
+        if feed is None:
+            return
+        if len(feed.deltas) == feed.deltas.maxlen:
+            feed.floor = feed.deltas[0][0]
+        feed.deltas.append((self.version, peer_key, joined))
+        feed.event.set()
+        feed.event = asyncio.Event()
+
+    async def wait(self, info_hash: str, cursor: Optional[str],
+                   timeout: float) -> Tuple[int, Optional[Tuple[List[PeerKey], List[PeerKey]]]]:
+        """
+        Chờ tối đa timeout giây cho tới khi swarm có thay đổi sau cursor.
+        Trả về (version hiện tại, (joined, left)), hoặc (version, None) nếu cursor không
+        dùng được và client phải lấy lại toàn bộ danh sách peer.
+        """
+        feed = self._feeds.get(info_hash)
+        if feed is None:
+            feed = self._feeds[info_hash] = _Feed(self.version)
+        since = self._parse_cursor(cursor)
+        # Chỉ chờ khi cursor hợp lệ và swarm chưa có thay đổi nào sau nó
+        if since is not None and since >= feed.floor and not (feed.deltas and feed.deltas[-1][0] > since):
+            feed.waiters += 1
+            try:
+                await asyncio.wait_for(feed.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                feed.waiters -= 1
+        feed.last_used = time.monotonic()
+        if since is None or since < feed.floor:
+            return self.version, None
+        return self.version, self._changes(feed, since)
+
+    @staticmethod
+    def _changes(feed: _Feed, since: int) -> Tuple[List[PeerKey], List[PeerKey]]:
+        # Gộp các thay đổi sau since theo peer: trạng thái cuối cùng của mỗi peer thắng
+        latest: Dict[PeerKey, bool] = {}
+        for version, peer_key, joined in reversed(feed.deltas):
+            if version <= since:
+                break
+            latest.setdefault(peer_key, joined)
+        joined = [peer_key for peer_key, state in latest.items() if state]
+        left = [peer_key for peer_key, state in latest.items() if not state]
+        return joined, left
+
+    def sweep(self) -> int:
+        """Bỏ feed của các swarm không còn ai theo dõi trong FEED_TTL giây. Trả về số feed đã bỏ."""
+        cutoff = time.monotonic() - FEED_TTL
+        idle = [info_hash for info_hash, feed in self._feeds.items()
+                if not feed.waiters and feed.last_used < cutoff]
+        for info_hash in idle:
+            del self._feeds[info_hash]
+        return len(idle)